@@ -0,0 +1,540 @@
+import bisect
+import contextlib
+import datetime
+import glob
+import functools
+import multiprocessing
+import numpy
+import pandas as pd
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import xlsxwriter
+
+import tt_script
+
+NUM_MATCHES = 1925481
+NUM_PLAYERS = 56971
+NUM_EXPORT_LOCATIONS = 40
+MATCHES_PER_PAGE = 100
+PAGES_PER_TOURNEY = 3
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+LOCATIONS = ['AB', 'AK', 'AL', 'AZ', 'BC', 'CA', 'CO', 'FL', 'GA', 'IL', 'MA', 'MD', 'NJ', 'NY', 'ON', 'PA', 'QC', 'TX', 'VA', 'WA', 'CAN', 'CHN', 'DEU', 'JPN', 'N/A', ' OTHER']
+
+def timed(func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+
+    return result, time.perf_counter() - start_time
+
+# builds a match store of random matches between NUM_PLAYERS players with fixed locations and ratings, skewed towards a few big locations
+def generate_match_store(num_matches, num_players=NUM_PLAYERS, num_locations=len(LOCATIONS), seed=0):
+    generator = numpy.random.default_rng(seed)
+    match_store = tt_script.MatchStore()
+    locations = (LOCATIONS + ['Z{:02d}'.format(index) for index in range(num_locations)])[:num_locations]
+    location_weights = 1 / numpy.arange(1, num_locations + 1)
+    player_locations = generator.choice(num_locations, size=num_players, p=location_weights / location_weights.sum())
+    player_ratings = numpy.clip(generator.normal(1500, 600, size=num_players), 0, 3000).astype(numpy.int16)
+    winners = generator.integers(num_players, size=num_matches)
+    losers = generator.integers(num_players, size=num_matches)
+
+    for location in locations:
+        match_store.location_code(location)
+
+    match_store.reserve(num_matches)
+    match_store.columns['tourney_id'][:num_matches] = numpy.sort(generator.integers(7000, size=num_matches))
+    match_store.columns['winner_id'][:num_matches] = winners
+    match_store.columns['loser_id'][:num_matches] = losers
+    match_store.columns['winner_rating'][:num_matches] = player_ratings[winners]
+    match_store.columns['loser_rating'][:num_matches] = player_ratings[losers]
+    match_store.columns['winner_location'][:num_matches] = player_locations[winners]
+    match_store.columns['loser_location'][:num_matches] = player_locations[losers]
+    match_store.size = num_matches
+
+    return match_store
+
+def benchmark_statistics(num_matches):
+    rating_bins = tt_script.create_rating_bins()
+    match_store = generate_match_store(num_matches)
+
+    populated_location_info_dict, build_time = timed(tt_script.build_location_info_dict, match_store, rating_bins, {})
+    location_stats, dict_time = timed(tt_script.calculate_statistics, populated_location_info_dict)
+    vectorized_location_stats, vectorized_time = timed(tt_script.calculate_statistics_vectorized, match_store, rating_bins, {})
+
+    assert location_stats == vectorized_location_stats, 'vectorized statistics differ from calculate_statistics'
+
+    print('calculate_statistics on {} matches:'.format(num_matches))
+    print('  dict of lists: {:.2f}s ({:.2f}s building the view + {:.2f}s aggregating)'.format(build_time + dict_time, build_time, dict_time))
+    print('  vectorized:    {:.2f}s ({:.1f}x faster)'.format(vectorized_time, (build_time + dict_time) / vectorized_time))
+
+# splits match_store into one store per tournament, each with its own location codes in first-seen order as a worker process would build them
+def shard_match_store(match_store):
+    tourney_ids = match_store['tourney_id']
+    boundaries = numpy.flatnonzero(numpy.diff(tourney_ids)) + 1
+    shards = []
+
+    for start, end in zip(numpy.concatenate([[0], boundaries]), numpy.concatenate([boundaries, [len(match_store)]])):
+        columns = { name: match_store[name][start:end].copy() for name in match_store.columns }
+        side_locations = numpy.stack([columns['winner_location'], columns['loser_location']], axis=1).ravel()
+        shard_codes, first_seen = numpy.unique(side_locations, return_index=True)
+        shard_codes = shard_codes[numpy.argsort(first_seen)]
+        code_map = numpy.zeros(len(match_store.locations), dtype=numpy.int16)
+        code_map[shard_codes] = numpy.arange(len(shard_codes))
+
+        for name in ['winner_location', 'loser_location']:
+            columns[name] = code_map[columns[name]]
+
+        shard = tt_script.MatchStore()
+        shard.__setstate__({ 'locations': [match_store.locations[code] for code in shard_codes], 'columns': columns })
+        shards.append(shard)
+
+    return shards
+
+def match_store_rows(match_store):
+    columns = [match_store[name] for name in match_store.columns]
+    locations = numpy.array(match_store.locations, dtype=object)
+
+    return columns[:5] + [locations[match_store['winner_location']], locations[match_store['loser_location']]]
+
+# merging per-tournament partial stores in order must reproduce the full store, however the merges are grouped
+def benchmark_match_store_merge(num_matches):
+    match_store = generate_match_store(num_matches)
+    shards = shard_match_store(match_store)
+
+    merged, merge_time = timed(lambda: functools.reduce(tt_script.MatchStore.merge, shards, tt_script.MatchStore()))
+    halves = [functools.reduce(tt_script.MatchStore.merge, shards[:len(shards) // 2], tt_script.MatchStore()), functools.reduce(tt_script.MatchStore.merge, shards[len(shards) // 2:], tt_script.MatchStore())]
+    regrouped = tt_script.MatchStore().merge(halves[0]).merge(halves[1])
+
+    for expected, merged_column, regrouped_column in zip(match_store_rows(match_store), match_store_rows(merged), match_store_rows(regrouped)):
+        assert numpy.array_equal(expected, merged_column) and numpy.array_equal(merged_column, regrouped_column), 'merged match stores differ'
+
+    print('Merging {} per-tournament match stores ({} matches): {:.2f}s'.format(len(shards), num_matches, merge_time))
+
+# folds every tournament into a StatisticsAccumulator as a streaming run would, checks the result against the exact statistics and
+# the documented median error bound of bin_width / 2, and compares the memory the accumulator holds (and peaks at) with the match store's
+def benchmark_streaming_statistics(num_matches, bin_widths=(tt_script.MEDIAN_BIN_WIDTH, 100)):
+    match_store = generate_match_store(num_matches)
+    rating_bins = tt_script.create_rating_bins()
+    shards = shard_match_store(match_store)
+    exact_stats = tt_script.calculate_statistics_vectorized(match_store, rating_bins, {})
+    match_store_bytes = sum(column.nbytes for column in match_store.columns.values())
+    accumulate = lambda bin_width: functools.reduce(tt_script.StatisticsAccumulator.add, shards, tt_script.StatisticsAccumulator(rating_bins, bin_width)).flush()
+
+    print('Streaming statistics over {} tournaments ({} matches, match store {:.1f} MB in memory):'.format(len(shards), num_matches, match_store_bytes / 2 ** 20))
+
+    for bin_width in bin_widths:
+        statistics, add_time = timed(accumulate, bin_width)
+        streaming_stats, stats_time = timed(tt_script.calculate_statistics_streaming, statistics, {})
+        max_median_error = 0
+
+        for rating_interval, stats_by_location in exact_stats.items():
+            for location, location_info in stats_by_location.items():
+                streaming_info = streaming_stats[rating_interval][location]
+                cells = [(location_info, streaming_info)] + [(state_stats, streaming_info['states_stats'][state]) for state, state_stats in location_info['states_stats'].items()]
+
+                for exact_cell, streaming_cell in cells:
+                    for stat in tt_script.STATS:
+                        if stat.startswith('median') and exact_cell[stat] != 'N/A':
+                            max_median_error = max(max_median_error, abs(streaming_cell[stat] - exact_cell[stat]))
+                        else:
+                            assert streaming_cell[stat] == exact_cell[stat], '{} differs between streaming and exact statistics'.format(stat)
+
+        assert max_median_error <= bin_width / 2 and (bin_width > 1 or streaming_stats == exact_stats), 'streaming medians exceed their error bound'
+
+        # accumulated again under tracemalloc, which would otherwise slow down the timed run
+        del statistics
+        tracemalloc.start()
+        statistics = accumulate(bin_width)
+        held_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('  bin width {}: {:.2f}s adding + {:.2f}s summarizing, {} cells, {:.1f} MB in memory (peak {:.1f} MB), max median error {}'.format(
+            bin_width, add_time, stats_time, len(statistics), held_bytes / 2 ** 20, peak_bytes / 2 ** 20, max_median_error))
+
+# rating histories of num_players players with num_entries tournaments each, out of num_tourneys consecutive daily tournaments
+def generate_rating_histories(num_players, num_entries, num_tourneys, seed=0):
+    generator = numpy.random.default_rng(seed)
+    tourney_dates = [synthetic_date(tourney_id).toordinal() for tourney_id in range(num_tourneys)]
+    rating_histories = []
+
+    for player_id in range(num_players):
+        dates = sorted(generator.choice(tourney_dates, size=num_entries, replace=False).tolist())
+        rating_histories.append(list(zip(dates, generator.integers(3000, size=num_entries).tolist())))
+
+    return rating_histories
+
+def benchmark_rating_history(num_matches, num_entries=30, num_tourneys=7000):
+    match_store = generate_match_store(num_matches)
+    match_store.columns['tourney_id'][:len(match_store)] = numpy.random.default_rng(1).integers(num_tourneys, size=len(match_store))
+    tourney_dates = { tourney_id: synthetic_date(tourney_id).toordinal() for tourney_id in range(num_tourneys) }
+    rating_histories = generate_rating_histories(NUM_PLAYERS, num_entries, num_tourneys)
+
+    rating_history, populate_time = timed(lambda: functools.reduce(lambda history, player: history.add(*player), enumerate(rating_histories), tt_script.RatingHistory()).flush())
+    _, apply_time = timed(rating_history.apply, match_store, tourney_dates)
+
+    # the scalar baseline binary searches each player's own sorted dates for every match
+    history_dates = [[date for date, _ in entries] for entries in rating_histories]
+    history_ratings = [[rating for _, rating in entries] for entries in rating_histories]
+    match_dates = [tourney_dates[tourney_id] for tourney_id in match_store['tourney_id'].tolist()]
+    scalar_rating = lambda player_id, date: history_ratings[player_id][max(bisect.bisect_left(history_dates[player_id], date) - 1, 0)]
+    scalar_ratings, scalar_time = timed(lambda: [[scalar_rating(player_id, date) for player_id, date in zip(match_store[side + '_id'].tolist(), match_dates)] for side in ['winner', 'loser']])
+
+    assert scalar_ratings == [match_store['winner_rating'].tolist(), match_store['loser_rating'].tolist()], 'rating history lookups differ from scalar lookups'
+
+    print('Rating history of {} players with {} tournaments each ({:.1f} MB):'.format(NUM_PLAYERS, num_entries, (rating_history.keys.nbytes + rating_history.ratings.nbytes) / 2 ** 20))
+    print('  populating: {:.2f}s'.format(populate_time))
+    print('  rating {} matches: {:.2f}s batched, {:.2f}s scalar ({:.1f}x faster)'.format(num_matches, apply_time, scalar_time, scalar_time / apply_time))
+
+def benchmark_rating_bins(num_ratings):
+    rating_bins = tt_script.create_rating_bins()
+    ratings = numpy.random.default_rng(0).integers(-100, 4100, size=num_ratings)
+    rating_list = ratings.tolist()
+
+    scalar_labels, scalar_time = timed(lambda: [rating_bins.label(rating) for rating in rating_list])
+    codes, batched_time = timed(rating_bins.codes, ratings)
+
+    assert scalar_labels == [rating_bins.labels[code] if code >= 0 else None for code in codes.tolist()], 'batched rating bins differ from scalar lookups'
+
+    print('RatingBins on {} ratings:'.format(num_ratings))
+    print('  scalar:  {:.2f}s ({:.0f} lookups/s)'.format(scalar_time, num_ratings / scalar_time))
+    print('  batched: {:.3f}s ({:.0f} lookups/s)'.format(batched_time, num_ratings / batched_time))
+
+# a player listing page shaped like /userAccount/s, with players first_id onwards in the second table and total as the player count
+def synthetic_player_page(num_rows, seed=0, first_id=0, total=None):
+    generator = numpy.random.default_rng(seed)
+    locations = generator.integers(len(LOCATIONS), size=num_rows).tolist()
+    ratings = generator.integers(3000, size=num_rows).tolist()
+    rows = []
+
+    for player_id, location, rating in zip(range(first_id, first_id + num_rows), locations, ratings):
+        rows.append(
+            '<tr class="list-item" onclick="location.href = \'/userAccount/up/{}?returnUrl=%2FuserAccount%2Fs\';">'
+            '<td>{}</td><td>Player</td><td>{}</td><td>M</td><td>01/01/2019</td><td>Springfield, {}</td><td>{}</td></tr>'.format(
+                player_id, player_id, 100000 + player_id, LOCATIONS[location], rating))
+
+    return '<html><body><span>Showing <strong>{}</strong> players</span><table><tr><td>filters</td></tr></table><table>{}</table></body></html>'.format(
+        num_rows if total is None else total, ''.join(rows))
+
+# tournaments are held one every day, from 01/01/2000 on
+def synthetic_date(tourney_id):
+    return datetime.date(2000, 1, 1) + datetime.timedelta(days=tourney_id)
+
+# a results page shaped like /t/tr/<id>, with a winner and loser cell per match and pagination links
+def synthetic_tourney_page(num_matches, num_pages=10, seed=0, num_players=NUM_PLAYERS):
+    generator = numpy.random.default_rng(seed)
+    rows = []
+
+    for winner_id, loser_id in generator.integers(num_players, size=(num_matches, 2)).tolist():
+        rows.append(
+            '<tr><td>Open Singles</td>'
+            '<td class="clickable" onclick="location.href = \'/userAccount/trn/tr?uai={}&amp;tid=1\';">Winner</td>'
+            '<td class="clickable" onclick="location.href = \'/userAccount/trn/tr?uai={}&amp;tid=1\';">Loser</td>'
+            '<td>11-5, 11-7, 11-9</td></tr>'.format(winner_id, loser_id))
+
+    steps = ''.join('<a class="step" href="/t/tr/1?max=100&amp;offset={}">{}</a>'.format(page * 100, page + 1) for page in range(num_pages))
+
+    return '<html><body><table>{}</table><div class="pagination">{}</div></body></html>'.format(''.join(rows), steps)
+
+# a tournament search page shaped like /t/search, with the tournaments in the first table
+def synthetic_tourney_list_page(tourney_ids, total):
+    rows = ''.join('<tr class="list-item" onclick="location.href = \'/t/{}?returnUrl=%2Ft%2Fsearch\';"><td>Open</td><td>{}</td></tr>'.format(
+        tourney_id, synthetic_date(tourney_id).strftime('%m/%d/%Y')) for tourney_id in tourney_ids)
+
+    return '<html><body><span>Found <strong>{}</strong> tournaments</span><table>{}</table></body></html>'.format(total, rows)
+
+# a player page shaped like /userAccount/up/<id>, with the player's tournament history and their rating after each tournament
+def synthetic_player_history_page(num_tourneys, seed=0):
+    generator = numpy.random.default_rng(seed)
+    rows = []
+
+    for tourney_id, rating in zip(sorted(generator.choice(10 * num_tourneys, size=num_tourneys, replace=False).tolist()), generator.integers(3000, size=num_tourneys).tolist()):
+        rows.append('<tr><td>Open {}</td><td>{}</td><td>{}</td></tr>'.format(tourney_id, synthetic_date(tourney_id).strftime('%m/%d/%Y'), rating))
+
+    return ('<html><body><span class="title less-margin">Player</span><small>USATT#: 100000</small>'
+            '<table><tr><th>Tournament</th><th>Date</th><th>Rating</th></tr>{}</table></body></html>'.format(''.join(rows)))
+
+EXTRACTORS = [
+    ('player rows', tt_script.extract_player_rows_bs, tt_script.extract_player_rows),
+    ('tourney rows', tt_script.extract_tourney_rows_bs, tt_script.extract_tourney_rows),
+    ('tourney dates', tt_script.extract_tourney_dates_bs, tt_script.extract_tourney_dates),
+    ('rating history', tt_script.extract_rating_history_bs, tt_script.extract_rating_history),
+    ('match cells', tt_script.extract_match_cells_bs, tt_script.extract_match_cells),
+    ('offset limit', tt_script.extract_offset_limit_bs, tt_script.extract_offset_limit)
+]
+
+# checks every extractor the BeautifulSoup path can run on a saved page against the streaming path
+def validate_extractors(pages):
+    for page_name, html_text in pages:
+        for extractor_name, bs_extractor, stream_extractor in EXTRACTORS:
+            try:
+                expected = bs_extractor(html_text)
+            except (AttributeError, IndexError, ValueError):
+                continue
+
+            assert stream_extractor(html_text) == expected, '{} of {} differ between the BeautifulSoup and streaming paths'.format(extractor_name, page_name)
+
+    print('Streaming extraction matches BeautifulSoup on {} pages.'.format(len(pages)))
+
+def benchmark_extraction():
+    pages = [('player listing', synthetic_player_page(1000), tt_script.extract_player_rows_bs, tt_script.extract_player_rows)]
+    pages += [('results page', synthetic_tourney_page(100), tt_script.extract_match_cells_bs, tt_script.extract_match_cells)]
+    pages += [('player page', synthetic_player_history_page(100), tt_script.extract_rating_history_bs, tt_script.extract_rating_history)]
+
+    validate_extractors([(page_name, html_text) for page_name, html_text, _, _ in pages])
+
+    for page_name, html_text, bs_extractor, stream_extractor in pages:
+        rows, bs_time = timed(lambda: [bs_extractor(html_text) for _ in range(10)])
+        _, stream_time = timed(lambda: [stream_extractor(html_text) for _ in range(10)])
+        num_rows = sum(len(page_rows) for page_rows in rows)
+
+        print('Extraction of a {} ({} rows):'.format(page_name, num_rows // 10))
+        print('  BeautifulSoup: {:.0f} rows/s'.format(num_rows / bs_time))
+        print('  streaming:     {:.0f} rows/s ({:.1f}x faster)'.format(num_rows / stream_time, bs_time / stream_time))
+
+# the worksheet writer as it was before formats were cached and rows streamed, kept as the export baseline
+def legacy_create_rating_interval_statistics_worksheet(location_stats, stats, workbook):
+    sorted_rating_intervals = sorted(list(location_stats.keys()), key=lambda interval: int(interval.split(':')[0].replace('+', '')))
+
+    for rating_interval in sorted_rating_intervals:
+        locations = set()
+        states = set()
+
+        for location in location_stats[rating_interval]:
+            locations.add(location)
+
+            if 'states_stats' in location_stats[rating_interval][location]:
+                for state in location_stats[rating_interval][location]['states_stats']:
+                    states.add(state)
+
+        sorted_locations = sorted(list(locations), key=lambda loc: (len(loc), loc))
+        sorted_states = sorted(list(states), key=lambda state: (len(state), state))
+        sorted_states_index_mapping = { state: index for index, state in enumerate(sorted_states) }
+        rating_interval_worksheet = workbook.add_worksheet('{} Statistics'.format(rating_interval.replace(':', ' to ')))
+        stat_title_row_index = 0
+
+        rating_interval_worksheet.set_column(0, 0, 20)
+
+        for stat in stats:
+            rating_interval_worksheet.write(stat_title_row_index, 0, stat, workbook.add_format({ 'bold': True, 'font_size': 20 }))
+
+            for location_index, location in enumerate(sorted_locations):
+                stat_table_row_index = stat_title_row_index + 2
+
+                rating_interval_worksheet.write(stat_table_row_index + location_index + 1, 0, location, workbook.add_format({ 'bold': True, 'align': 'center' }))
+
+                for state in sorted_states:
+                    rating_interval_worksheet.write(stat_table_row_index, sorted_states_index_mapping[state] + 1, state, workbook.add_format({ 'bold': True, 'align': 'center' }))
+
+                    if not location_stats[rating_interval][location]['states_stats'] or state not in location_stats[rating_interval][location]['states_stats']:
+                        rating_interval_worksheet.write(stat_table_row_index + location_index + 1, sorted_states_index_mapping[state] + 1, 'N/A', workbook.add_format({ 'align': 'center' }))
+                    elif stat in location_stats[rating_interval][location]['states_stats'][state]:
+                        state_stat = location_stats[rating_interval][location]['states_stats'][state][stat]
+
+                        rating_interval_worksheet.write(stat_table_row_index + location_index + 1, sorted_states_index_mapping[state] + 1, state_stat, workbook.add_format({ 'align': 'center' }))
+                    else:
+                        rating_interval_worksheet.write(stat_table_row_index + location_index + 1, sorted_states_index_mapping[state] + 1, 'N/A', workbook.add_format({ 'align': 'center' }))
+
+            stat_title_row_index = stat_table_row_index + len(sorted_locations) + 2
+
+# runs in a fresh process so ru_maxrss only reflects this writer; reports the build time and how far writing raised the peak RSS
+def excel_export_worker(legacy, num_matches, results):
+    match_store = generate_match_store(num_matches, num_locations=NUM_EXPORT_LOCATIONS)
+    location_stats = tt_script.calculate_statistics_vectorized(match_store, tt_script.create_rating_bins(), {})
+    del match_store
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start_time = time.perf_counter()
+
+        if legacy:
+            workbook = xlsxwriter.Workbook(os.path.join(output_dir, 'tt_statistics.xlsx'))
+            legacy_create_rating_interval_statistics_worksheet(location_stats, tt_script.STATS, workbook)
+        else:
+            workbook = xlsxwriter.Workbook(os.path.join(output_dir, 'tt_statistics.xlsx'), { 'constant_memory': True })
+            tt_script.create_rating_interval_statistics_worksheet(location_stats, tt_script.STATS, workbook)
+
+        workbook.close()
+        results.put((time.perf_counter() - start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss))
+
+def benchmark_excel_export(num_matches):
+    results = multiprocessing.Queue()
+
+    print('Excel export of {} locations:'.format(NUM_EXPORT_LOCATIONS))
+
+    for name, legacy in [('per-cell formats', True), ('streamed rows', False)]:
+        worker = multiprocessing.Process(target=excel_export_worker, args=(legacy, num_matches, results))
+        worker.start()
+        worker.join()
+
+        if worker.exitcode:
+            print('  {}: worker exited with code {}'.format(name, worker.exitcode))
+            continue
+
+        build_time, peak_rss_increase = results.get()
+        print('  {}: {:.2f}s, peak RSS +{:.0f} MB'.format(name, build_time, peak_rss_increase / 1024))
+
+# checks the tidy table against location_stats, then times each export format and a single-cell query against the indexed database
+def benchmark_table_export(num_matches):
+    match_store = generate_match_store(num_matches)
+    location_stats = tt_script.calculate_statistics_vectorized(match_store, tt_script.create_rating_bins(), {})
+    location_stats_frame = tt_script.location_stats_frame(location_stats)
+
+    for interval, location, opponent, stat, value in location_stats_frame.sample(1000, random_state=0).itertuples(index=False):
+        cell_stats = location_stats[interval][location] if pd.isna(opponent) else location_stats[interval][location]['states_stats'][opponent]
+        expected = cell_stats.get(stat, 'N/A')
+
+        assert (numpy.isnan(value) and expected == 'N/A') or value == expected
+
+    print('Table export of {} location_stats rows and {} matches:'.format(len(location_stats_frame), len(match_store)))
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        for export_format in tt_script.EXPORT_FORMATS:
+            _, export_time = timed(tt_script.export_tables, location_stats, match_store, export_dir, [export_format])
+            print('  {}: {:.2f}s'.format(export_format, export_time))
+
+        with sqlite3.connect(os.path.join(export_dir, 'tt_statistics.sqlite')) as connection:
+            query = 'SELECT opponent, value FROM location_stats WHERE interval = ? AND location = ? AND stat = ?'
+            start_time = time.perf_counter()
+            rows = connection.execute(query, ('1501:1750', 'CA', 'avg_win_rating_diff')).fetchall()
+            print('  sqlite query of one cell: {} rows in {:.2f}ms'.format(len(rows), (time.perf_counter() - start_time) * 1000))
+
+        connection.close()
+
+# records every page a USE_MAX run requests into a page archive: the player listing, the tournament search and PAGES_PER_TOURNEY
+# results pages per tournament, enough tournaments for at least num_matches matches
+def synthetic_num_tourneys(num_matches):
+    return -(-num_matches // (MATCHES_PER_PAGE * PAGES_PER_TOURNEY))
+
+# (URL path, page) of every page a run of the whole script requests from a site of num_matches matches between num_players players
+def synthetic_site_pages(num_matches, num_players=NUM_PLAYERS):
+    players_per_page = min(num_players, 1000)
+    num_tourneys = synthetic_num_tourneys(num_matches)
+    tourneys_per_page = min(num_tourneys, 100)
+
+    yield '/userAccount/s?max=5', synthetic_player_page(0, total=num_players)
+
+    for offset in range(0, num_players, players_per_page):
+        yield '/userAccount/s?max={}&offset={}'.format(players_per_page, offset), synthetic_player_page(min(players_per_page, num_players - offset), offset, offset, num_players)
+
+    yield '/t/search', synthetic_tourney_list_page([], num_tourneys)
+
+    for offset in range(0, num_tourneys, tourneys_per_page):
+        yield '/t/search?max={}&offset={}'.format(tourneys_per_page, offset), synthetic_tourney_list_page(range(offset, min(offset + tourneys_per_page, num_tourneys)), num_tourneys)
+
+    for tourney_id in range(num_tourneys):
+        for page in range(PAGES_PER_TOURNEY):
+            tourney_path = '/t/tr/{}?max={}&offset={}'.format(tourney_id, MATCHES_PER_PAGE, page * MATCHES_PER_PAGE)
+            yield tourney_path, synthetic_tourney_page(MATCHES_PER_PAGE, PAGES_PER_TOURNEY, tourney_id * PAGES_PER_TOURNEY + page, num_players)
+
+def build_page_archive(path, num_matches, num_players=NUM_PLAYERS):
+    page_archive = tt_script.PageArchive(path, 'w')
+
+    for page_path, page in synthetic_site_pages(num_matches, num_players):
+        page_archive.put(tt_script.URL + page_path, page)
+
+    page_archive.close()
+
+    return synthetic_num_tourneys(num_matches) * PAGES_PER_TOURNEY * MATCHES_PER_PAGE
+
+# ingests the same replayed pages with get_main_info serially and with tournaments parsed on a pool of num_processes processes, which
+# must give the same match store, and reports the speedup of the pool
+def benchmark_process_pool(num_matches, num_processes=max(os.cpu_count() or 1, 2)):
+    csv_path = os.path.join(os.path.dirname(os.path.abspath(tt_script.__file__)), tt_script.US_CITIES_STATES_CSV)
+    working_dir = os.getcwd()
+    ingestion_times = {}
+    match_stores = {}
+
+    with tempfile.TemporaryDirectory() as run_dir:
+        archive_path = os.path.join(run_dir, 'pages.zip')
+        build_page_archive(archive_path, num_matches)
+        os.chdir(run_dir)
+        tt_script.USE_MAX = True
+        tt_script.fetcher = tt_script.Fetcher(mode='replay', archive_path=archive_path)
+
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                city_state_index = tt_script.load_city_state_index(csv_path)
+                player_info_dict, _ = tt_script.get_preliminary_dicts(tt_script.create_rating_bins(), city_state_index)
+
+                for processes in [1, num_processes]:
+                    (_, match_stores[processes]), ingestion_times[processes] = timed(lambda: tt_script.get_main_info(player_info_dict, city_state_index, num_processes=processes))
+                    os.remove(tt_script.INGEST_STATE)
+        finally:
+            os.chdir(working_dir)
+
+    for serial_column, pool_column in zip(match_store_rows(match_stores[1]), match_store_rows(match_stores[num_processes])):
+        assert numpy.array_equal(serial_column, pool_column), 'ingesting on a process pool gives a different match store'
+
+    print('Ingestion of {} replayed matches on {} CPUs:'.format(len(match_stores[1]), os.cpu_count()))
+    print('  serial:      {:.2f}s'.format(ingestion_times[1]))
+    print('  {} processes: {:.2f}s ({:.2f}x)'.format(num_processes, ingestion_times[num_processes], ingestion_times[1] / ingestion_times[num_processes]))
+
+# runs tt_script.main() in a scratch directory with every page replayed from the archive, and reports its run report
+def end_to_end_worker(archive_path, results):
+    csv_path = os.path.join(os.path.dirname(os.path.abspath(tt_script.__file__)), tt_script.US_CITIES_STATES_CSV)
+
+    with tempfile.TemporaryDirectory() as run_dir:
+        os.symlink(csv_path, os.path.join(run_dir, os.path.basename(csv_path)))
+        os.chdir(run_dir)
+        tt_script.USE_MAX = True
+        tt_script.fetcher = tt_script.Fetcher(mode='replay', archive_path=archive_path)
+        tt_script.run_report.reset()
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            tt_script.main()
+
+        results.put(tt_script.run_report.report())
+
+def benchmark_end_to_end(num_matches):
+    results = multiprocessing.Queue()
+
+    with tempfile.TemporaryDirectory() as archive_dir:
+        archive_path = os.path.join(archive_dir, 'pages.zip')
+        num_archived_matches, build_time = timed(build_page_archive, archive_path, num_matches)
+
+        print('End to end run on {} replayed matches (archive built in {:.1f}s, {:.0f} MB):'.format(num_archived_matches, build_time, os.path.getsize(archive_path) / 2 ** 20))
+
+        worker = multiprocessing.Process(target=end_to_end_worker, args=(archive_path, results))
+        worker.start()
+        worker.join()
+
+    if worker.exitcode:
+        return print('  worker exited with code {}'.format(worker.exitcode))
+
+    report = results.get()
+
+    for stage, stage_report in report['stages'].items():
+        print('  {}: {:.2f}s'.format(stage, stage_report['seconds']))
+
+    print('  total: {:.2f}s, {:.0f} pages/s, {:.0f} matches/s, peak RSS {:.0f} MB'.format(
+        report['total_seconds'], report['rates']['tourney_pages_per_second'], report['rates']['matches_per_second'], report['peak_memory_mb']))
+
+def main():
+    num_matches = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MATCHES
+
+    # the saved pages in FIXTURE_DIR, and any further arguments, are pages to validate the streaming extractors against
+    pages = []
+
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html'))) + sys.argv[2:]:
+        with open(path, encoding='utf-8') as f:
+            pages.append((path, f.read()))
+
+    validate_extractors(pages)
+
+    benchmark_extraction()
+    benchmark_rating_bins(2 * num_matches)
+    benchmark_statistics(num_matches)
+    benchmark_match_store_merge(num_matches)
+    benchmark_streaming_statistics(num_matches)
+    benchmark_rating_history(num_matches)
+    benchmark_excel_export(num_matches)
+    benchmark_table_export(num_matches)
+    benchmark_process_pool(num_matches)
+    benchmark_end_to_end(num_matches)
+
+if __name__ == '__main__':
+    main()
@@ -1,71 +1,1004 @@
+import atexit
+import bisect
+import contextlib
 import copy
+import datetime
+import difflib
+import glob
+import hashlib
+import html
 import itertools
+import json
+import marshal
+import multiprocessing
+import threading
 import numpy
 import os
 import pandas as pd
 import pickle
+import random
 import re
+import shutil
+import sqlite3
 import requests
 import string
 import time
+import types
 import xlsxwriter
+import zipfile
+import zlib
 
 from bs4 import BeautifulSoup
-from intervaltree import IntervalTree
+from collections import deque
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pprint import pprint
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 NUM_INT_PLAYERS_LIMIT = 5
 NUM_US_PLAYERS_LIMIT = 5
 NUM_TOURNEYS_LIMIT = 3
 URL = 'https://usatt.simplycompete.com'
 USE_MAX = True
+HTML_PARSER = 'stream'
+US_CITIES_STATES_CSV = './us_cities_states_counties.csv'
+CITY_STATE_INDEX_DIR = './pickle/city_state_index'
+FUZZY_CITY_MATCH = False
+FUZZY_CITY_CUTOFF = 0.85
+STREAMING_STATS = False
+MEDIAN_BIN_WIDTH = 25
+STATS_BUFFER_MATCHES = 100000
+RATING_BIN_EDGES = [0, 250, 500, 750, 1000, 1250, 1500, 1750, 2000, 2250, 2500, 4000]
+MAX_WORKERS = 8
+NUM_PROCESSES = 1
+REQUESTS_PER_SECOND = 4
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 2
+BACKOFF_MAX = 120
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_CACHE_DIR = './pickle/http'
+FETCH_MODE = 'live'
+PAGE_ARCHIVE = './pickle/pages.zip'
+INGEST_STATE = './pickle/.get_main_info_state.pkl'
+PRELIMINARY_CHECKPOINT = './pickle/.get_preliminary_dicts_checkpoint.pkl'
+PRELIMINARY_SEED = './pickle/.get_preliminary_dicts.pkl'
+PRELIMINARY_SEED_USED = './pickle/.get_preliminary_dicts_seeded'
+CHECKPOINT_SECONDS = 120
+PLAYER_LOOKUPS = './pickle/player_lookups.pkl'
+RESOLVE_UNKNOWN_PLAYERS = False
+USE_RATING_HISTORY = False
+RATING_HISTORY = './pickle/rating_history.pkl'
+CACHE_DIR = './pickle/cache'
+CACHE_VERSION = 1
+CACHE_TTL = 30 * 24 * 60 * 60
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+EXPORT_DIR = './export'
+EXPORT_FORMATS = ['parquet', 'csv', 'sqlite']
+REPORT_PATH = './tt_report.json'
+SHOW_PROGRESS = False
+PROGRESS_SECONDS = 10
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+STATS = sorted(['avg_loss_rating_diff', 'avg_win_rating_diff', 'median_loss_rating_diff', 'median_win_rating_diff', 'num_losses', 'num_wins', 'win_ratio'])
+
+def load_checkpoint(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+# writes to a temporary file first so a crash mid-write never leaves a corrupt checkpoint behind
+def save_checkpoint(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+# saves crawl state at most once every CHECKPOINT_SECONDS; callers only invoke it at points where the state is consistent
+class Checkpointer:
+    def __init__(self, path, interval=CHECKPOINT_SECONDS):
+        self.path = path
+        self.interval = interval
+        self.last_save_time = time.monotonic()
+
+    def maybe_save(self, state):
+        if time.monotonic() - self.last_save_time >= self.interval:
+            self.save(state)
+
+    def save(self, state):
+        save_checkpoint(self.path, state)
+        self.last_save_time = time.monotonic()
+
+cache_stats = { 'hits': 0, 'misses': 0, 'load_time': 0.0, 'store_time': 0.0 }
+
+def cache_key_part(value):
+    if isinstance(value, (dict, list, tuple)):
+        return hashlib.sha1(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+    return repr(value)
+
+# bytecode, names and constants of code and of the functions and lambdas defined in it; frozensets of constants (from `x in {...}`) are
+# sorted, since their order changes with string hashing from one interpreter to the next
+def code_fingerprint(code):
+    parts = [code.co_code, code.co_names]
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(code_fingerprint(const))
+        elif isinstance(const, frozenset):
+            parts.append(sorted(map(repr, const)))
+        else:
+            parts.append(const)
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+# the key covers the arguments, the function's code (see code_fingerprint), CACHE_VERSION and the globals that change what gets scraped
+def cache_key(func, args, kwargs):
+    key_parts = [func.__name__, CACHE_VERSION, code_fingerprint(func.__code__), USE_MAX, NUM_INT_PLAYERS_LIMIT, NUM_US_PLAYERS_LIMIT, NUM_TOURNEYS_LIMIT]
+    key_parts += [cache_key_part(arg) for arg in args]
+    key_parts += [(name, cache_key_part(kwargs[name])) for name in sorted(kwargs)]
+
+    return hashlib.sha1(repr(key_parts).encode()).hexdigest()
+
+# marshal loads plain dicts, lists, tuples and ints noticeably faster than pickle; anything else falls back to pickle
+def serialize(value):
+    try:
+        return b'M' + marshal.dumps(value)
+    except ValueError:
+        return b'P' + pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+def deserialize(data):
+    if data[:1] == b'M':
+        return marshal.loads(data[1:])
+    return pickle.loads(data[1:])
+
+# drops entries past CACHE_TTL, then the least recently used ones until the cache fits in CACHE_MAX_BYTES. Files still being written and
+# entries another thread removes meanwhile are skipped
+def evict_cache_entries(cache_dir=CACHE_DIR):
+    entries = []
+    now = time.time()
+
+    for name in os.listdir(cache_dir):
+        if name.endswith('.tmp'):
+            continue
+
+        path = os.path.join(cache_dir, name)
+
+        try:
+            entry_stat = os.stat(path)
+
+            if now - entry_stat.st_mtime > CACHE_TTL:
+                os.remove(path)
+            else:
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, path))
+        except FileNotFoundError:
+            pass
+
+    total_size = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total_size <= CACHE_MAX_BYTES:
+            break
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total_size -= size
 
 def cache_info(func):
-    def wrapper(*args):
-        cache = './pickle/{}'.format('.{}.pkl'.format(func.__name__).replace('/', '_'))
-        os.makedirs(os.path.dirname(cache), exist_ok=True)
+    def wrapper(*args, **kwargs):
+        cache = os.path.join(CACHE_DIR, '{}-{}.bin'.format(func.__name__, cache_key(func, args, kwargs)))
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        start_time = time.perf_counter()
 
         try:
-            with open(cache, 'rb') as f:
-                return pickle.load(f)
-        except IOError:
-            result = func(*args)
-            with open(cache, 'wb') as f:
-                pickle.dump(result, f)
-            return result
- 
+            if time.time() - os.stat(cache).st_mtime <= CACHE_TTL:
+                with open(cache, 'rb') as f:
+                    result = deserialize(f.read())
+
+                # touching the entry marks it as recently used for eviction
+                os.utime(cache)
+                cache_stats['hits'] += 1
+                cache_stats['load_time'] += time.perf_counter() - start_time
+                return result
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+        cache_stats['misses'] += 1
+        result = func(*args, **kwargs)
+        start_time = time.perf_counter()
+
+        with open(cache + '.tmp', 'wb') as f:
+            f.write(serialize(result))
+        os.replace(cache + '.tmp', cache)
+        evict_cache_entries()
+        cache_stats['store_time'] += time.perf_counter() - start_time
+
+        return result
+
     return wrapper
 
-@cache_info
-def parse_us_cities_states_csv():
-    us_cities_states_dict = {}
+# wall time per stage (inclusive of nested stages), event counters and histograms of observed values for one run, written out as JSON at the end
+class RunReport:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.stages = {}
+            self.counters = {}
+            self.observations = {}
+
+    # usable both as a context manager and as a function decorator
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, { 'calls': 0, 'seconds': 0.0 })
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+
+    # yields the items of iterable, counting the time spent waiting for each as the named stage
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+
+            if item is StopIteration:
+                return
+            yield item
+
+    def count(self, name, increment=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def observe(self, name, value):
+        with self.lock:
+            self.observations.setdefault(name, []).append(value)
+
+    def rate(self, counter, stage):
+        seconds = self.stages.get(stage, {}).get('seconds', 0)
+
+        return self.counters.get(counter, 0) / seconds if seconds else None
+
+    @staticmethod
+    def histogram(values, buckets=LATENCY_BUCKETS):
+        values = numpy.array(values, dtype=numpy.float64)
+        bucket_counts = numpy.bincount(numpy.searchsorted(buckets, values), minlength=len(buckets) + 1)
+        bucket_labels = ['<={}'.format(bucket) for bucket in buckets] + ['>{}'.format(buckets[-1])]
+        p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+
+        return {
+            'count': len(values),
+            'mean': float(values.mean()),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99),
+            'max': float(values.max()),
+            'buckets': dict(zip(bucket_labels, bucket_counts.tolist()))
+        }
+
+    # peak resident memory of the process so far, where the platform reports it (ru_maxrss is in KB on Linux)
+    @staticmethod
+    def peak_memory_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None
+
+    def report(self):
+        with self.lock:
+            stages = copy.deepcopy(self.stages)
+            counters = dict(self.counters)
+            observations = { name: list(values) for name, values in self.observations.items() }
+
+        return {
+            'total_seconds': time.perf_counter() - self.start_time,
+            'stages': stages,
+            'counters': counters,
+            'rates': {
+                'player_pages_per_second': self.rate('player_pages', 'get_preliminary_dicts'),
+                'tourney_pages_per_second': self.rate('tourney_pages', 'get_main_info'),
+                'matches_per_second': self.rate('matches', 'get_main_info')
+            },
+            'histograms': { name: self.histogram(values) for name, values in observations.items() if values },
+            'peak_memory_mb': self.peak_memory_mb(),
+            'fetch': fetcher.report(),
+            'cache': dict(cache_stats)
+        }
+
+    def write(self, path=REPORT_PATH):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+run_report = RunReport()
+
+# prints how far a long loop has got, its rate and the estimated time left, at most once every PROGRESS_SECONDS and only with SHOW_PROGRESS
+class Progress:
+    def __init__(self, label, total, done=0):
+        self.label = label
+        self.total = total
+        self.initial_done = done
+        self.start_time = time.monotonic()
+        self.last_print_time = self.start_time
+
+    def update(self, done):
+        now = time.monotonic()
+
+        if not SHOW_PROGRESS or now - self.last_print_time < PROGRESS_SECONDS:
+            return
+
+        self.last_print_time = now
+        rate = (done - self.initial_done) / (now - self.start_time)
+        eta = '{:.0f}s'.format((self.total - done) / rate) if rate else 'unknown'
+        print('{}: {}/{} ({:.1f}/s, ETA {})'.format(self.label, done, self.total, rate, eta))
+
+# spaces out request starts across all threads so concurrent fetching stays polite to the server
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_request_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+            return wait_time
+        return 0
+
+# compressed zip of raw page bodies keyed by their URL relative to URL, so an archive recorded against one host replays against any other
+class PageArchive:
+    def __init__(self, path, mode='r'):
+        if mode != 'r':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.zip_file = zipfile.ZipFile(path, mode, compression=zipfile.ZIP_DEFLATED)
+        self.names = set(self.zip_file.namelist())
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, url):
+        return self.entry_name(url) in self.names
+
+    @staticmethod
+    def entry_name(url):
+        if url.startswith(URL):
+            url = url[len(URL):]
+
+        return '{}.html'.format(hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        name = self.entry_name(url)
+
+        with self.lock:
+            if name not in self.names:
+                return None
+            return self.zip_file.read(name).decode('utf-8')
+
+    # the first recorded body of a URL is kept
+    def put(self, url, text):
+        name = self.entry_name(url)
+
+        with self.lock:
+            if name not in self.names:
+                self.zip_file.writestr(name, text)
+                self.names.add(name)
+
+    def close(self):
+        with self.lock:
+            self.zip_file.close()
+
+# single shared fetch layer: pooled keep-alive session, rate limiting, retries with backoff and ETag/Last-Modified revalidation
+class Fetcher:
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND, pool_size=MAX_WORKERS, max_retries=MAX_RETRIES, cache_dir=HTTP_CACHE_DIR, mode=FETCH_MODE, archive_path=PAGE_ARCHIVE):
+        if mode not in ['live', 'record', 'replay']:
+            raise ValueError('Unknown fetch mode {!r}, expected \'live\', \'record\' or \'replay\'.'.format(mode))
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.archive_path = archive_path
+        self.archive = None
+        self.lock = threading.Lock()
+        self.unevicted_bytes = CACHE_MAX_BYTES
+        self.counters = { 'replayed': 0, 'requests': 0, 'bytes': 0, 'retries': 0, 'errors': 0, 'not_modified': 0, 'latency': 0.0, 'max_latency': 0.0, 'rate_limit_wait': 0.0, 'backoff_wait': 0.0 }
+
+    def count(self, **increments):
+        with self.lock:
+            for name, increment in increments.items():
+                self.counters[name] += increment
+
+    def validator_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    # validators (and the body they validate) past CACHE_TTL are ignored; using them marks them as recently used for eviction
+    def load_validators(self, url):
+        path = self.validator_path(url)
+
+        try:
+            if time.time() - os.stat(path).st_mtime > CACHE_TTL:
+                return None
+
+            with open(path, 'rb') as f:
+                etag, last_modified, body = pickle.load(f)
+            os.utime(path)
+
+            return etag, last_modified, zlib.decompress(body).decode('utf-8')
+        except (IOError, EOFError, pickle.UnpicklingError, zlib.error):
+            return None
+
+    def save_validators(self, url, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+        if not etag and not last_modified:
+            return
+
+        path = self.validator_path(url)
+        body = zlib.compress(response.text.encode('utf-8'))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((etag, last_modified, body), f)
+        os.replace(path + '.tmp', path)
+
+        # the directory is evicted like the function cache on the first save, then again after every sixteenth of CACHE_MAX_BYTES written
+        with self.lock:
+            self.unevicted_bytes += len(body)
+            evict = self.unevicted_bytes >= CACHE_MAX_BYTES // 16
+
+            if evict:
+                self.unevicted_bytes = 0
+
+        if evict:
+            evict_cache_entries(self.cache_dir)
+
+    def backoff(self, attempt, retry_after=None):
+        self.count(retries=1)
+
+        # full jitter: sleep anywhere between 0 and the exponential cap, unless the server asks for a specific delay
+        if retry_after and retry_after.isdigit():
+            delay = min(BACKOFF_MAX, int(retry_after))
+        else:
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        self.count(backoff_wait=delay)
+        time.sleep(delay)
+
+    # the archive is opened on first use; a recording is only complete once it is closed, which also happens at exit
+    def page_archive(self):
+        with self.lock:
+            if self.archive is None:
+                self.archive = PageArchive(self.archive_path, 'r' if self.mode == 'replay' else 'a')
+
+                if self.mode == 'record':
+                    atexit.register(self.archive.close)
+
+        return self.archive
+
+    # live fetches from the site, record additionally saves every page to the archive and replay serves pages from it without network access
+    def get(self, url):
+        if self.mode == 'replay':
+            text = self.page_archive().get(url)
+
+            if text is None:
+                raise LookupError('{} is not in the page archive {}.'.format(url, self.archive_path))
+            self.count(replayed=1)
+            return text
+
+        text = self.fetch(url)
+
+        if self.mode == 'record':
+            self.page_archive().put(url, text)
+
+        return text
+
+    def fetch(self, url):
+        validators = self.load_validators(url)
+        headers = {}
+
+        if validators:
+            etag, last_modified, cached_text = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        for attempt in range(self.max_retries + 1):
+            self.count(rate_limit_wait=self.rate_limiter.wait())
+            start_time = time.monotonic()
+
+            try:
+                response = self.session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.count(errors=1)
+
+                if attempt == self.max_retries:
+                    raise
+                print('Request to {} failed ({}). Retrying.'.format(url, type(e).__name__))
+                self.backoff(attempt)
+                continue
+
+            latency = time.monotonic() - start_time
+
+            with self.lock:
+                self.counters['requests'] += 1
+                self.counters['bytes'] += len(response.content)
+                self.counters['latency'] += latency
+                self.counters['max_latency'] = max(self.counters['max_latency'], latency)
+
+            run_report.observe('request_latency', latency)
+
+            if response.status_code == 304 and validators:
+                self.count(not_modified=1)
+                return cached_text
+
+            if response.status_code in RETRY_STATUSES:
+                self.count(errors=1)
+
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                print('Request to {} returned {}. Retrying.'.format(url, response.status_code))
+                self.backoff(attempt, response.headers.get('Retry-After'))
+                continue
+
+            # any other error status fails the fetch, so an error page is never taken for a page without data
+            response.raise_for_status()
+            self.save_validators(url, response)
+
+            return response.text
+
+    def report(self):
+        with self.lock:
+            report = dict(self.counters)
+
+        report['avg_latency'] = report['latency'] / report['requests'] if report['requests'] else 0
+
+        return report
+
+fetcher = Fetcher()
+
+# like map, but runs func on a bounded thread (or, with executor_class, process) pool and still yields results in the order of items
+# on the calling thread, so work done on each result there, such as parsing a fetched page, counts towards the caller's stage times
+def ordered_map(func, items, max_workers, executor_class=ThreadPoolExecutor, **executor_kwargs):
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with executor_class(max_workers=max_workers, **executor_kwargs) as executor:
+        pending = deque()
+
+        for item in items:
+            pending.append(executor.submit(func, item))
+
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+# city -> state short lookup over sorted, memory-mapped arrays of keys normalized with reformat_location; loaded on first use
+class CityStateIndex:
+    def __init__(self, index_dir, fuzzy=FUZZY_CITY_MATCH):
+        self.index_dir = index_dir
+        self.fuzzy = fuzzy
+        self.arrays = None
+        self.fuzzy_matches = {}
+
+    def __repr__(self):
+        return 'CityStateIndex({!r}, fuzzy={})'.format(self.index_dir, self.fuzzy)
+
+    def load(self):
+        if self.arrays is None:
+            self.arrays = tuple(numpy.load(os.path.join(self.index_dir, '{}.npy'.format(name)), mmap_mode='r') for name in ['cities', 'states'])
+
+        return self.arrays
+
+    def find(self, city):
+        cities, states = self.load()
+        key = reformat_location(city.strip()).encode('utf-8')
+        index = numpy.searchsorted(cities, key)
+
+        if index < len(cities) and cities[index] == key:
+            return states[index].decode('utf-8')
+        return None
+
+    # misspelled cities are matched against the indexed cities sharing their first letter; results are remembered per index
+    def find_fuzzy(self, city):
+        if city not in self.fuzzy_matches:
+            cities, _ = self.load()
+            first_letter = city[:1].encode('utf-8')
+            start, end = numpy.searchsorted(cities, [first_letter, first_letter + b'\xff'])
+            candidates = [candidate.decode('utf-8') for candidate in cities[start:end]]
+            matches = difflib.get_close_matches(city, candidates, n=1, cutoff=FUZZY_CITY_CUTOFF)
+            self.fuzzy_matches[city] = self.find(matches[0]) if matches else None
+
+        return self.fuzzy_matches[city]
+
+    def __contains__(self, city):
+        return self.find(city) is not None
+
+    def __getitem__(self, city):
+        state = self.find(city)
+
+        if state is None:
+            raise KeyError(city)
+        return state
+
+    def lookup(self, city):
+        state = self.find(city)
+
+        if state is None and self.fuzzy and city:
+            state = self.find_fuzzy(city)
+        return state
+
+def build_city_state_index(csv_path, index_dir):
     fields = ['City', 'State short', 'City alias']
-    df = pd.read_csv('./us_cities_states_counties.csv', sep='|', usecols=fields)
+    df = pd.read_csv(csv_path, sep='|', usecols=fields, dtype=str)
+    cities = df[['City', 'State short']].set_axis(['city', 'state'], axis=1)
+    aliases = df[['City alias', 'State short']].set_axis(['city', 'state'], axis=1)
+
+    # interleaving each row's city and alias keeps the csv's precedence when a city appears in several states: the last one wins
+    entries = pd.concat([cities, aliases]).sort_index(kind='stable').dropna()
+    entries['city'] = entries['city'].str.strip()
+    unique_cities = entries['city'].unique()
+    entries['city'] = entries['city'].map(dict(zip(unique_cities, map(reformat_location, unique_cities))))
+    entries = entries[entries['city'] != ''].drop_duplicates('city', keep='last').sort_values('city')
 
-    for index, row in df.iterrows():
-        us_cities_states_dict[row['City']] = row['State short']
+    os.makedirs(index_dir + '.tmp', exist_ok=True)
+    numpy.save(os.path.join(index_dir + '.tmp', 'cities.npy'), entries['city'].str.encode('utf-8').to_numpy(dtype=bytes))
+    numpy.save(os.path.join(index_dir + '.tmp', 'states.npy'), entries['state'].str.encode('utf-8').to_numpy(dtype=bytes))
+    os.replace(index_dir + '.tmp', index_dir)
 
-        if row['City alias'] != '':
-            us_cities_states_dict[row['City alias']] = row['State short']
+# the index lives in a directory named after the csv's size and modification time, so editing the csv rebuilds it
+def load_city_state_index(csv_path=US_CITIES_STATES_CSV):
+    csv_stat = os.stat(csv_path)
+    index_dir = '{}-{}-{}'.format(CITY_STATE_INDEX_DIR, csv_stat.st_size, csv_stat.st_mtime_ns)
 
-    return us_cities_states_dict
+    if not os.path.isdir(index_dir):
+        build_city_state_index(csv_path, index_dir)
+
+        for stale_index_dir in glob.glob(CITY_STATE_INDEX_DIR + '-*'):
+            if stale_index_dir != index_dir:
+                shutil.rmtree(stale_index_dir, ignore_errors=True)
+
+    return CityStateIndex(index_dir)
 
 def retrieve_href(string):
     return string.replace('location.href = \'', '').replace('\';', '')
 
+TAG_PATTERN = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.S | re.I)
+ATTRIBUTE_PATTERN = re.compile(r'([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+)))?')
+MARKUP_PATTERN = re.compile(r'<!--.*?-->|<[^>]*>', re.S)
+DATE_PATTERN = re.compile(r'(?<!\d)(\d{1,2})/(\d{1,2})/(\d{4})(?!\d)')
+
+# single pass over the tags of a page, yielding (is_end_tag, tag, raw attributes, start, end); comments, scripts and styles are skipped
+def iter_tags(html_text):
+    for match in TAG_PATTERN.finditer(html_text):
+        if match.group(3):
+            tag = match.group(3).lower()
+            yield match.group(2) == '/', tag, match.group(4), match.start(), match.end()
+
+            # a self-closing tag such as <td/> is an empty element
+            if match.group(4).rstrip().endswith('/') and match.group(2) != '/':
+                yield True, tag, '', match.end(), match.end()
+
+def parse_attributes(raw_attributes):
+    return { match.group(1).lower(): html.unescape(next((value for value in match.group(2, 3, 4) if value is not None), '')) for match in ATTRIBUTE_PATTERN.finditer(raw_attributes) }
+
+def has_class(attributes, *class_names):
+    return any(class_name in attributes.get('class', '').split() for class_name in class_names)
+
+# text between start and end with the markup removed; like BeautifulSoup, a text node of nothing but whitespace becomes a single newline
+# if it has one and a single space otherwise
+def markup_text(html_text, start, end):
+    return ''.join(map(collapse_whitespace, MARKUP_PATTERN.split(html_text[start:end])))
+
+def collapse_whitespace(text_node):
+    text_node = html.unescape(text_node)
+
+    if text_node and not text_node.strip(' \t\n\r\f'):
+        return '\n' if '\n' in text_node else ' '
+    return text_node
+
+# the table, tr and td elements of html_text nested the way BeautifulSoup nests them: an end tag closes the innermost open element of its
+# kind together with every element opened inside it, an end tag without an open element is ignored, and elements left open run to the
+# end of the page. Yields (False, tag, raw attributes, start, end) for every start tag and (True, tag, '', content start, content end) for
+# every closed element, innermost first
+def iter_table_elements(html_text):
+    open_elements = []
+
+    for is_end_tag, tag, raw_attributes, start, end in iter_tags(html_text):
+        if tag not in ['table', 'tr', 'td']:
+            continue
+
+        if not is_end_tag:
+            open_elements.append((tag, end))
+            yield False, tag, raw_attributes, start, end
+        elif any(open_tag == tag for open_tag, _ in open_elements):
+            while True:
+                open_tag, content_start = open_elements.pop()
+                yield True, open_tag, '', content_start, start
+
+                if open_tag == tag:
+                    break
+
+    while open_elements:
+        open_tag, content_start = open_elements.pop()
+        yield True, open_tag, '', content_start, len(html_text)
+
+# the streaming extractors below return the same values as their BeautifulSoup counterparts, which remain selectable through HTML_PARSER
+def extract_player_rows_bs(html_text):
+    tables = BeautifulSoup(html_text, 'html.parser').find_all('table')
+
+    if len(tables) < 2:
+        raise ValueError('The player listing has no players table.')
+
+    return [(player_row.get('onclick'), [cell.text for cell in player_row.find_all('td')]) for player_row in tables[1].find_all('tr', { 'class': 'list-item' })]
+
+# (onclick, cell texts) of every list-item row inside the second table of a player listing
+def extract_player_rows(html_text):
+    if HTML_PARSER == 'bs4':
+        return extract_player_rows_bs(html_text)
+
+    player_rows = []
+    table_depth = 0
+    num_tables = 0
+    open_rows = []
+    open_cells = []
+
+    for is_end_tag, tag, raw_attributes, start, end in iter_table_elements(html_text):
+        if tag == 'table':
+            if not is_end_tag:
+                num_tables += 1
+                table_depth = table_depth + 1 if table_depth or num_tables == 2 else 0
+            elif table_depth:
+                table_depth -= 1
+
+                if not table_depth:
+                    break
+        elif not table_depth:
+            continue
+        elif tag == 'tr' and not is_end_tag:
+            attributes = parse_attributes(raw_attributes)
+
+            # rows are listed in the order they open, and a cell belongs to every row it is nested in
+            open_rows.append((attributes.get('onclick'), []) if has_class(attributes, 'list-item') else None)
+
+            if open_rows[-1]:
+                player_rows.append(open_rows[-1])
+        elif tag == 'tr':
+            open_rows.pop()
+        elif tag == 'td' and not is_end_tag:
+            cell_slots = [(cells, len(cells)) for _, cells in filter(None, open_rows)]
+
+            for cells, _ in cell_slots:
+                cells.append('')
+            open_cells.append(cell_slots)
+        else:
+            cell_text = markup_text(html_text, start, end)
+
+            for cells, cell_index in open_cells.pop():
+                cells[cell_index] = cell_text
+
+    if num_tables < 2:
+        raise ValueError('The player listing has no players table.')
+
+    return player_rows
+
+# the list-item rows of the first table of a tournament listing
+def tourney_list_rows_bs(html_text):
+    tourneys_table = BeautifulSoup(html_text, 'html.parser').find('table')
+
+    if tourneys_table is None:
+        raise ValueError('The tournament listing has no tournaments table.')
+
+    return tourneys_table.find_all('tr', { 'class': 'list-item' })
+
+def extract_tourney_rows_bs(html_text):
+    return [tourney.get('onclick') for tourney in tourney_list_rows_bs(html_text)]
+
+# (onclick, text) of every list-item row inside the first table of a tournament listing
+def tourney_list_rows(html_text):
+    tourney_rows = []
+    table_depth = 0
+    open_rows = []
+
+    for is_end_tag, tag, raw_attributes, start, end in iter_table_elements(html_text):
+        if tag == 'table':
+            table_depth += -1 if is_end_tag else 1
+
+            if not table_depth:
+                return tourney_rows
+        elif not table_depth:
+            continue
+        elif tag == 'tr' and not is_end_tag:
+            attributes = parse_attributes(raw_attributes)
+            open_rows.append(len(tourney_rows) if has_class(attributes, 'list-item') else None)
+
+            if open_rows[-1] is not None:
+                tourney_rows.append([attributes.get('onclick'), ''])
+        elif tag == 'tr':
+            row_index = open_rows.pop()
+
+            if row_index is not None:
+                tourney_rows[row_index][1] = markup_text(html_text, start, end)
+
+    raise ValueError('The tournament listing has no tournaments table.')
+
+# onclick of every list-item row inside the first table of a tournament listing
+def extract_tourney_rows(html_text):
+    if HTML_PARSER == 'bs4':
+        return extract_tourney_rows_bs(html_text)
+
+    return [tourney_onclick for tourney_onclick, _ in tourney_list_rows(html_text)]
+
+def extract_match_cells_bs(html_text):
+    return [cell.get('onclick') for cell in BeautifulSoup(html_text, 'html.parser').find_all('td', { 'class': 'clickable' })]
+
+# onclick (None when missing) of every clickable cell of a results page; consecutive cells are the winner and loser of a match
+def extract_match_cells(html_text):
+    if HTML_PARSER == 'bs4':
+        return extract_match_cells_bs(html_text)
+
+    match_cells = []
+
+    for is_end_tag, tag, raw_attributes, start, end in iter_tags(html_text):
+        if tag == 'td' and not is_end_tag and 'clickable' in raw_attributes:
+            attributes = parse_attributes(raw_attributes)
+
+            if has_class(attributes, 'clickable'):
+                match_cells.append(attributes.get('onclick'))
+
+    return match_cells
+
+def extract_offset_limit_bs(html_text):
+    tourney_page = BeautifulSoup(html_text, 'html.parser')
+
+    try:
+        if (tourney_page.find('span', { 'class': ['step', 'gap'] })):
+            return int(re.search(r'offset=(\d+)', tourney_page.find('span', { 'class': ['step', 'gap'] }).next_sibling['href']).group(1))
+        return int(re.search(r'offset=(\d+)', tourney_page.find_all('a', { 'class': 'step'})[-1]['href']).group(1))
+    except:
+        return 0
+
+# offset of the last results page: the link right after the pagination gap if there is one, otherwise the last step link
+def extract_offset_limit(html_text):
+    if HTML_PARSER == 'bs4':
+        return extract_offset_limit_bs(html_text)
+
+    last_step_href = None
+    gap_depth = 0
+    span_depth = 0
+
+    for is_end_tag, tag, raw_attributes, start, end in iter_tags(html_text):
+        if tag == 'span':
+            if not is_end_tag:
+                span_depth += 1
+
+                if not gap_depth and has_class(parse_attributes(raw_attributes), 'step', 'gap'):
+                    gap_depth = span_depth
+            elif gap_depth and span_depth == gap_depth:
+                # only a tag starting right after the gap counts as its sibling; text or a closing tag means there is no link
+                sibling = TAG_PATTERN.match(html_text, end)
+                sibling_href = parse_attributes(sibling.group(4)).get('href') if sibling and sibling.group(3) and sibling.group(2) != '/' else None
+                offset_match = re.search(r'offset=(\d+)', sibling_href or '')
+
+                return int(offset_match.group(1)) if offset_match else 0
+            elif span_depth:
+                # like BeautifulSoup, an end tag without an open span is ignored
+                span_depth -= 1
+        elif tag == 'a' and not is_end_tag and not gap_depth:
+            attributes = parse_attributes(raw_attributes)
+
+            if has_class(attributes, 'step'):
+                last_step_href = attributes.get('href')
+
+    offset_match = re.search(r'offset=(\d+)', last_step_href or '')
+
+    return int(offset_match.group(1)) if offset_match else 0
+
+# ordinal of the first MM/DD/YYYY date in text (the start date of a date range), or None if there is no valid date
+def parse_date(text):
+    date_match = DATE_PATTERN.search(text)
+
+    try:
+        return datetime.date(int(date_match.group(3)), int(date_match.group(1)), int(date_match.group(2))).toordinal()
+    except (AttributeError, ValueError):
+        return None
+
+def extract_tourney_dates_bs(html_text):
+    return [parse_date(tourney.text) for tourney in tourney_list_rows_bs(html_text)]
+
+# date (see parse_date) of every list-item row inside the first table of a tournament listing, in the order of extract_tourney_rows
+def extract_tourney_dates(html_text):
+    if HTML_PARSER == 'bs4':
+        return extract_tourney_dates_bs(html_text)
+
+    return [parse_date(tourney_text) for _, tourney_text in tourney_list_rows(html_text)]
+
+# (date, rating) of every table row with a date among its cells and a rating as its last cell, which on a player page are the rows of
+# their tournament history: the date of each tournament and the player's rating after it
+def rating_history_entries(table_rows):
+    entries = []
+
+    for cells in table_rows:
+        date = next((date for date in map(parse_date, cells) if date is not None), None)
+        rating = cells[-1].strip() if cells else ''
+
+        if date is not None and rating.isdigit():
+            entries.append((date, int(rating)))
+
+    return entries
+
+def extract_rating_history_bs(html_text):
+    return rating_history_entries([[cell.text for cell in row.find_all('td')] for row in BeautifulSoup(html_text, 'html.parser').find_all('tr')])
+
+# rating history entries of a player page, see rating_history_entries
+def extract_rating_history(html_text):
+    if HTML_PARSER == 'bs4':
+        return extract_rating_history_bs(html_text)
+
+    table_rows = []
+    open_rows = []
+    open_cells = []
+
+    for is_end_tag, tag, raw_attributes, start, end in iter_table_elements(html_text):
+        if tag == 'tr' and not is_end_tag:
+            open_rows.append([])
+            table_rows.append(open_rows[-1])
+        elif tag == 'tr':
+            open_rows.pop()
+        elif tag == 'td' and not is_end_tag:
+            # a cell belongs to every row it is nested in
+            cell_slots = [(cells, len(cells)) for cells in open_rows]
+
+            for cells, _ in cell_slots:
+                cells.append('')
+            open_cells.append(cell_slots)
+        elif tag == 'td':
+            cell_text = markup_text(html_text, start, end)
+
+            for cells, cell_index in open_cells.pop():
+                cells[cell_index] = cell_text
+
+    return rating_history_entries(table_rows)
+
 def player_table_helper(players_per_page, offset, is_US):
     base_string = '{}/userAccount/s?max={}&offset={}&format=&showUsCitizensOnly=on' if is_US else '{}/userAccount/s?max={}&offset={}'
     players_href = base_string.format(URL, players_per_page, offset)
-    players_request = requests.get(players_href)
-    players_page = BeautifulSoup(players_request.text, 'html.parser')
-    players_table = players_page.find_all('table')[1]
 
-    return players_table
+    return fetcher.get(players_href)
 
 def find_num_players(is_US):
     base_string = '{}/userAccount/s?max=5&format=&showUsCitizensOnly=on' if is_US else '{}/userAccount/s?max=5'
-    players_request = requests.get(base_string.format(URL))
-    players_page = BeautifulSoup(players_request.text, 'html.parser')
+    players_page = BeautifulSoup(fetcher.get(base_string.format(URL)), 'html.parser')
 
     for span in players_page.find_all('span'):
         element = span.find('strong')
@@ -79,11 +1012,12 @@ def reformat_location(location):
         return location.upper()
     return string.capwords(location.lower())
 
-def parse_player_info(us_cities_states_dict, player_row):
-    player_url = retrieve_href(player_row['onclick'])
+def parse_player_info(city_state_index, player_row):
+    onclick, cells = player_row
+    player_url = retrieve_href(onclick)
     player_id = int(re.search(r'.*\/(.*)\?', player_url).group(1))
-    rating = int(player_row.find_all('td')[6].text)
-    locations = player_row.find_all('td')[5].text.split(',')
+    rating = int(cells[6])
+    locations = cells[5].split(',')
     main_location = reformat_location(locations[-1].strip())
     backup_location = reformat_location(locations[0].strip())
     selected_location = None
@@ -92,100 +1026,237 @@ def parse_player_info(us_cities_states_dict, player_row):
         if backup_location == '':
             selected_location = ' OTHER'
         else:
-            if backup_location in us_cities_states_dict:
-                selected_location = us_cities_states_dict[backup_location]
-            else:
-                selected_location = ' OTHER'
+            selected_location = city_state_index.lookup(backup_location) or ' OTHER'
     else:
         selected_location = main_location
 
     return player_id, rating, selected_location
 
-def create_interval_tree():
-    rating_intervals = IntervalTree()
-    rating_intervals[0:250] = '0:250' 
-    rating_intervals[250:500] = '251:500'
-    rating_intervals[500:750] = '501:750'
-    rating_intervals[750:1000] = '751:1000'
-    rating_intervals[1000:1250] = '1001:1250'
-    rating_intervals[1250:1500] = '1251:1500'
-    rating_intervals[1500:1750] = '1501:1750'
-    rating_intervals[1750:2000] = '1751:2000'
-    rating_intervals[2000:2250] = '2001:2250'
-    rating_intervals[2250:2500] = '2251:2500'
-    rating_intervals[2500:4000] = '2501+'
-
-    return rating_intervals
+# buckets ratings into the half-open intervals [edges[i], edges[i + 1]); ratings outside [edges[0], edges[-1]) belong to no bucket
+class RatingBins:
+    def __init__(self, edges=RATING_BIN_EDGES, labels=None):
+        if len(edges) < 2 or any(low >= high for low, high in zip(edges, edges[1:])):
+            raise ValueError('Rating bin edges must be strictly increasing and contain at least two values: {}'.format(edges))
+        if labels is not None and len(labels) != len(edges) - 1:
+            raise ValueError('Expected {} rating bin labels but got {}.'.format(len(edges) - 1, len(labels)))
+
+        self.edges = list(edges)
+        self.edge_array = numpy.array(edges, dtype=numpy.int64)
+        self.labels = list(labels) if labels is not None else self.default_labels(self.edges)
+
+    def __repr__(self):
+        return 'RatingBins({}, {})'.format(self.edges, self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    # e.g. '0:250', '251:500', ..., '2501+'
+    @staticmethod
+    def default_labels(edges):
+        labels = ['{}:{}'.format(low + 1 if index else low, high) for index, (low, high) in enumerate(zip(edges, edges[1:]))]
+        labels[-1] = '{}+'.format(edges[-2] + 1)
+
+        return labels
+
+    def code(self, rating):
+        code = bisect.bisect_right(self.edges, rating) - 1
+
+        return code if 0 <= code < len(self.labels) else -1
+
+    def label(self, rating):
+        code = self.code(rating)
+
+        return self.labels[code] if code >= 0 else None
+
+    def codes(self, ratings):
+        codes = numpy.searchsorted(self.edge_array, ratings, side='right') - 1
+        codes[codes >= len(self.labels)] = -1
+
+        return codes
 
+def create_rating_bins(edges=RATING_BIN_EDGES):
+    return RatingBins(edges)
+
+# adds an empty win/loss entry for the location under the player's rating interval, if missing
+def add_location_info(location_info_dict, rating_bins, selected_location, rating):
+    rating_range = rating_bins.label(rating)
+
+    if rating_range is None:
+        return
+
+    if rating_range in location_info_dict:
+        if selected_location not in location_info_dict[rating_range]:
+            location_info_dict[rating_range][selected_location]  = { 'W': {}, 'L': {} }
+    else:
+        location_info_dict[rating_range] = {}
+        location_info_dict[rating_range][selected_location] = { 'W': {}, 'L': {} }
+
+# is_US may also be a list such as [True, False] to crawl several listings in one pass, equivalent to crawling them one after another
+@run_report.stage('get_preliminary_dicts')
 @cache_info
-def get_preliminary_dicts(rating_intervals, us_cities_states_dict, offset=0, is_US=False, max_players_per_page=1000):
+def get_preliminary_dicts(rating_bins, city_state_index, offset=0, is_US=False, max_players_per_page=1000, max_workers=MAX_WORKERS):
+    listings = list(is_US) if isinstance(is_US, (list, tuple)) else [is_US]
     player_info_dict = {}
     location_info_dict = {}
-    num_players = None
+    pages = []
 
-    if USE_MAX:
-        num_players = find_num_players(is_US)
-    else:
-        num_players = NUM_US_PLAYERS_LIMIT if is_US else NUM_INT_PLAYERS_LIMIT
+    # the shipped (player_info_dict, location_info_dict) of the full crawl, saved before results were cached by argument, stands in for
+    # the first default crawl so it doesn't take an hour; from then on the crawl is cached (and refreshed after CACHE_TTL) as usual
+    if USE_MAX and listings == [False] and offset == 0 and os.path.exists(PRELIMINARY_SEED) and not os.path.exists(PRELIMINARY_SEED_USED):
+        seed_player_info_dict, _ = load_checkpoint(PRELIMINARY_SEED)
+        print('Seeding player information from {}.'.format(PRELIMINARY_SEED))
+
+        for player_id, (selected_location, rating) in seed_player_info_dict.items():
+            player_info_dict[player_id] = (selected_location, rating)
+            add_location_info(location_info_dict, rating_bins, selected_location, rating)
+
+        open(PRELIMINARY_SEED_USED, 'w').close()
+
+        return player_info_dict, location_info_dict
+
+    # every page offset is known up front, so the pages of all listings are fetched concurrently and parsed in order as they arrive
+    for listing in listings:
+        if USE_MAX:
+            num_players = find_num_players(listing)
+        else:
+            num_players = NUM_US_PLAYERS_LIMIT if listing else NUM_INT_PLAYERS_LIMIT
 
-    while offset < num_players:
-        if USE_MAX and offset % 5000 == 0 and offset != 0:
-            print('Completed information gathering for {} players.'.format(offset))
         players_per_page = num_players if num_players < max_players_per_page else max_players_per_page
-        players_table = player_table_helper(players_per_page, offset, is_US)
+        pages += [(players_per_page, page_offset, listing) for page_offset in range(offset, num_players, players_per_page or 1)]
 
-        for player_row in players_table.find_all('tr', { 'class': 'list-item' }):
-            player_id, rating, selected_location = parse_player_info(us_cities_states_dict, player_row)
+    checkpointer = Checkpointer(PRELIMINARY_CHECKPOINT)
+    checkpoint = load_checkpoint(PRELIMINARY_CHECKPOINT)
+    first_page = 0
 
-            player_info_dict[player_id] = (selected_location, rating)
-            rating_range = None
+    if checkpoint and checkpoint.get('pages') == pages:
+        first_page = checkpoint['next_page']
+        player_info_dict = checkpoint['player_info_dict']
+        location_info_dict = checkpoint['location_info_dict']
+        print('Resuming player information gathering from page {} of {}.'.format(first_page, len(pages)))
 
-            try:
-                rating_range = rating_intervals[rating].pop().data
-            except:
-                continue
+    progress = Progress('Player pages', len(pages), first_page)
+    player_pages = ordered_map(lambda page: player_table_helper(*page), pages[first_page:], max_workers)
 
-            if rating_range in location_info_dict:
-                if selected_location not in location_info_dict[rating_range]:
-                    location_info_dict[rating_range][selected_location]  = { 'W': {}, 'L': {} }
-            else:
-                location_info_dict[rating_range] = {}
-                location_info_dict[rating_range][selected_location] = { 'W': {}, 'L': {} }
+    for page_index, players_page in enumerate(player_pages, first_page):
+        page_offset = pages[page_index][1]
+
+        with run_report.stage('parse_player_pages'):
+            player_rows = extract_player_rows(players_page)
+
+        if USE_MAX and page_offset % 5000 == 0 and page_offset != 0:
+            print('Completed information gathering for {} players.'.format(page_offset))
+
+        run_report.count('player_pages')
+        run_report.count('players', len(player_rows))
 
-        offset += players_per_page
-        time.sleep(1)
+        for player_row in player_rows:
+            player_id, rating, selected_location = parse_player_info(city_state_index, player_row)
+
+            player_info_dict[player_id] = (selected_location, rating)
+            add_location_info(location_info_dict, rating_bins, selected_location, rating)
+
+        progress.update(page_index + 1)
+        checkpointer.maybe_save({
+            'location_info_dict': location_info_dict,
+            'next_page': page_index + 1,
+            'pages': pages,
+            'player_info_dict': player_info_dict
+        })
+
+    if os.path.exists(PRELIMINARY_CHECKPOINT):
+        os.remove(PRELIMINARY_CHECKPOINT)
 
     return player_info_dict, location_info_dict
 
-# adds player to player_info_dict if not existent
-def add_player(player_id, player_info_dict, us_cities_states_dict, nonexistent_usatt_ids):
-    player_request = requests.get('{}/userAccount/up/{}'.format(URL, player_id))
-    player_page = BeautifulSoup(player_request.text, 'html.parser')
+# fetches the player's page and searches the player listing for their USATT number; returns the USATT number along with
+# the parsed (player_id, rating, location) of the search result, or None if the search found nothing
+def lookup_player(player_id, city_state_index):
+    player_page = BeautifulSoup(fetcher.get('{}/userAccount/up/{}'.format(URL, player_id)), 'html.parser')
 
     usatt_id = player_page.find('span', { 'class': ['title', 'less-margin'] }).findNext('small').text.split(': ')[1].strip()
-    filter_request = requests.get('{}/userAccount/s?searchBy=usattNumber&query={}'.format(URL, usatt_id))
-    filter_page = BeautifulSoup(filter_request.text, 'html.parser')
+    filter_page = fetcher.get('{}/userAccount/s?searchBy=usattNumber&query={}'.format(URL, usatt_id))
+
+    # a search page without a players table raises, as it isn't a search that found nothing
+    player_rows = extract_player_rows(filter_page)
 
     try:
-        table = filter_page.find_all('table')[1]
-        player_row = table.find('tr', { 'class': 'list-item' })
-        player_id, rating, selected_location = parse_player_info(us_cities_states_dict, player_row)
+        return usatt_id, parse_player_info(city_state_index, player_rows[0])
+    except (IndexError, ValueError, AttributeError):
+        return usatt_id, None
+
+def record_player_lookup(player_lookup, player_info_dict, nonexistent_usatt_ids):
+    usatt_id, player_info = player_lookup
 
+    # a player whose page was missing or could not be parsed has no USATT number to report
+    if player_info is None:
+        if usatt_id is not None and usatt_id not in nonexistent_usatt_ids:
+            print('USATT number {} does not exist.'.format(usatt_id))
+            nonexistent_usatt_ids.add(usatt_id)
+    else:
+        player_id, rating, selected_location = player_info
         player_info_dict[player_id] = (selected_location, rating)
         print('Added {} to player_info_dict.'.format(player_id))
-    except:
-        if usatt_id not in nonexistent_usatt_ids:
-            print('USATT number {} does not exist.'.format(usatt_id))
-            nonexistent_usatt_ids.append(usatt_id)
+
+# adds player to player_info_dict if not existent
+def add_player(player_id, player_info_dict, city_state_index, nonexistent_usatt_ids):
+    record_player_lookup(lookup_player(player_id, city_state_index), player_info_dict, nonexistent_usatt_ids)
+
+# player_id -> (lookup time, lookup_player result) for every player looked up so far, both found and not found; entries expire after CACHE_TTL
+def load_player_lookups():
+    player_lookups = load_checkpoint(PLAYER_LOOKUPS) or {}
+    expiry_time = time.time() - CACHE_TTL
+
+    return { player_id: entry for player_id, entry in player_lookups.items() if entry[0] >= expiry_time }
+
+# a page that is missing (an error status that isn't retried, see RETRY_STATUSES) or can't be parsed fails the same way on every retry,
+# unlike a connection error or a server error
+def is_permanent_lookup_error(error):
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else None
+        return status_code is not None and 400 <= status_code < 500 and status_code not in RETRY_STATUSES
+
+    return not isinstance(error, requests.RequestException)
+
+# adds every player of player_ids missing from player_info_dict, looking up each distinct player at most once and concurrently. Players
+# whose lookup failed permanently are recorded and cached as not found. Lookups that failed on a transient error are neither recorded nor
+# cached; the ids of those players are returned
+def resolve_players(player_ids, player_info_dict, city_state_index, nonexistent_usatt_ids, player_lookups, max_workers=MAX_WORKERS):
+    def try_lookup_player(player_id):
+        try:
+            return lookup_player(player_id, city_state_index)
+        except (requests.RequestException, AttributeError, IndexError, ValueError) as e:
+            if is_permanent_lookup_error(e):
+                print('Player {} could not be found ({}).'.format(player_id, e))
+                return None, None
+
+            print('Could not look up player {} ({}).'.format(player_id, e))
+            return None
+
+    unknown_ids = list(dict.fromkeys(player_id for player_id in player_ids if player_id not in player_info_dict))
+    new_ids = [player_id for player_id in unknown_ids if player_id not in player_lookups]
+    failed_ids = []
+
+    for player_id, player_lookup in zip(new_ids, ordered_map(try_lookup_player, new_ids, max_workers)):
+        if player_lookup is None:
+            failed_ids.append(player_id)
+        else:
+            player_lookups[player_id] = (time.time(), player_lookup)
+
+    for player_id in unknown_ids:
+        if player_id in player_lookups:
+            record_player_lookup(player_lookups[player_id][1], player_info_dict, nonexistent_usatt_ids)
+
+    return failed_ids
 
 def find_num_tourneys():
     tourneys_href = '{}/t/search'.format(URL)
-    tourneys_request = requests.get(tourneys_href)
-    tourneys_page = BeautifulSoup(tourneys_request.text, 'html.parser')
+    tourneys_page = BeautifulSoup(fetcher.get(tourneys_href), 'html.parser')
 
     return int(tourneys_page.find('strong').text)
 
-def get_tourney_ids(tourneys_per_page=100, offset=0):
+# the date of every listed tournament that has one is recorded in tourney_dates, if given, as tourney_id -> date ordinal
+@run_report.stage('get_tourney_ids')
+def get_tourney_ids(tourneys_per_page=100, offset=0, tourney_dates=None):
     num_tourneys = find_num_tourneys() if USE_MAX else NUM_TOURNEYS_LIMIT
     tourney_ids = []
 
@@ -194,140 +1265,484 @@ def get_tourney_ids(tourneys_per_page=100, offset=0):
 
     while offset < num_tourneys:
         tourneys_href = '{}/t/search?max={}&offset={}'.format(URL, tourneys_per_page, offset)
-        tourneys_request = requests.get(tourneys_href)
-        tourneys_page = BeautifulSoup(tourneys_request.text, 'html.parser')
-        tourneys_table = tourneys_page.find('table')
+        tourneys_page = fetcher.get(tourneys_href)
+        page_dates = extract_tourney_dates(tourneys_page) if tourney_dates is not None else []
 
-        for tourney in tourneys_table.find_all('tr', { 'class': 'list-item' }):
-            tourney_url = retrieve_href(tourney['onclick'])
+        for index, tourney_onclick in enumerate(extract_tourney_rows(tourneys_page)):
+            tourney_url = retrieve_href(tourney_onclick)
             tourney_id = int(re.search(r'.*\/(.*)\?', tourney_url).group(1))
             tourney_ids.append(tourney_id)
 
+            if index < len(page_dates) and page_dates[index] is not None:
+                tourney_dates[tourney_id] = page_dates[index]
+
         offset += tourneys_per_page
 
     return tourney_ids
 
-@cache_info
-def get_main_info(rating_intervals, player_info_dict, location_info_dict, us_cities_states_dict, matches_per_page=100):
-    def tourney_page_helper(offset, nonexistent_usatt_ids):
-        num_matches = 0
-        tourney_string = '{}/t/tr/{}?max={}&offset={}'.format(URL, tourney_id, matches_per_page, offset)
-        apply_timeout = True
-        tourney_request = None
-
-        while apply_timeout:
-            try:
-                tourney_request = requests.get(tourney_string)
-                apply_timeout = False
-            except requests.exceptions.Timeout:
-                print('Encountered timeout error. Waiting 60 seconds until trying again.')
-                time.sleep(60)
-            except ConnectionError:
-                print('Connection has been aborted. Waiting 60 seconds until trying again.')
-                time.sleep(60)
-            except:
-                print('Error has occurred. Waiting 60 seconds until trying again.')
-                time.sleep(60)
-
-        tourney_page = BeautifulSoup(tourney_request.text, 'html.parser')
-        player_matches = tourney_page.find_all('td', { 'class': 'clickable' })
-
-        for winner, loser in zip(player_matches[0::2], player_matches[1::2]):
-            num_matches += 1
-            winner_id = None
-            loser_id = None
+def fetch_tourney_page(tourney_id, matches_per_page, offset):
+    tourney_string = '{}/t/tr/{}?max={}&offset={}'.format(URL, tourney_id, matches_per_page, offset)
+
+    return fetcher.get(tourney_string)
+
+# fetches the (offset, page) pairs of a tournament not in ingested_offsets; the first page is always needed to find how many pages follow
+def fetch_tourney_pages(tourney_id, matches_per_page, ingested_offsets=()):
+    tourney_page = fetch_tourney_page(tourney_id, matches_per_page, 0)
+    tourney_pages = [] if 0 in ingested_offsets else [(0, tourney_page)]
+    offset_limit = extract_offset_limit(tourney_page)
+
+    for offset in range(matches_per_page, offset_limit + 1, matches_per_page):
+        if offset not in ingested_offsets:
+            tourney_pages.append((offset, fetch_tourney_page(tourney_id, matches_per_page, offset)))
+
+    return tourney_pages
+
+# compact columnar record of every attributed match; locations are those of the players at ingestion time, and so are ratings unless
+# they were rated at their tournament's date with a RatingHistory
+class MatchStore:
+    COLUMNS = [
+        ('tourney_id', numpy.int32),
+        ('winner_id', numpy.int32),
+        ('loser_id', numpy.int32),
+        ('winner_rating', numpy.int16),
+        ('loser_rating', numpy.int16),
+        ('winner_location', numpy.int16),
+        ('loser_location', numpy.int16)
+    ]
+
+    def __init__(self, capacity=1024):
+        self.locations = []
+        self.location_codes = {}
+        self.size = 0
+        self.columns = { name: numpy.empty(capacity, dtype=dtype) for name, dtype in self.COLUMNS }
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        return { 'locations': self.locations, 'columns': { name: self[name].copy() for name in self.columns } }
+
+    def __setstate__(self, state):
+        self.locations = state['locations']
+        self.location_codes = { location: code for code, location in enumerate(self.locations) }
+        self.columns = state['columns']
+        self.size = len(self.columns['tourney_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.size]
+
+    def location_code(self, location):
+        if location not in self.location_codes:
+            self.location_codes[location] = len(self.locations)
+            self.locations.append(location)
+
+        return self.location_codes[location]
+
+    def reserve(self, num_rows):
+        if self.size + num_rows > len(self.columns['tourney_id']):
+            capacity = max(2 * len(self.columns['tourney_id']), self.size + num_rows)
+
+            for name in self.columns:
+                column = numpy.empty(capacity, dtype=self.columns[name].dtype)
+                column[:self.size] = self[name]
+                self.columns[name] = column
+
+    def add_match(self, tourney_id, winner_id, winner_location, winner_rating, loser_id, loser_location, loser_rating):
+        self.reserve(1)
+        row = self.size
+        self.columns['tourney_id'][row] = tourney_id
+        self.columns['winner_id'][row] = winner_id
+        self.columns['loser_id'][row] = loser_id
+        self.columns['winner_rating'][row] = winner_rating
+        self.columns['loser_rating'][row] = loser_rating
+        self.columns['winner_location'][row] = self.location_code(winner_location)
+        self.columns['loser_location'][row] = self.location_code(loser_location)
+        self.size += 1
+
+    # appends the rows of other after this store's own, remapping other's location codes onto this store's. Merging is associative,
+    # so folding the stores of consecutive shards in order gives exactly the store a serial run over all of them builds
+    def merge(self, other):
+        location_codes = numpy.array([self.location_code(location) for location in other.locations], dtype=numpy.int16)
+        self.reserve(len(other))
+
+        for name in self.columns:
+            column = other[name]
+
+            if name in ['winner_location', 'loser_location'] and len(other):
+                column = location_codes[column]
+
+            self.columns[name][self.size:self.size + len(other)] = column
+
+        self.size += len(other)
+
+        return self
+
+# record of every tournament already folded into the match store, so later runs only scrape new tournaments, and of its result page
+# offsets, so an interrupted tournament resumes where it stopped. Ingested tournaments are never fetched again
+def load_ingest_state():
+    ingest_state = load_checkpoint(INGEST_STATE)
+
+    if ingest_state is None:
+        return {
+            'ingested_pages': {},
+            'ingested_tourneys': set(),
+            'match_store': MatchStore(),
+            'nonexistent_usatt_ids': set(),
+            'total_num_matches': 0
+        }
+
+    # states saved before nonexistent_usatt_ids became a set
+    ingest_state['nonexistent_usatt_ids'] = set(ingest_state['nonexistent_usatt_ids'])
+
+    return ingest_state
+
+# every known rating of every player as two parallel arrays sorted by key, where an entry's key packs its player and date as
+# player_id << DATE_BITS | date ordinal and its rating is the player's rating after their tournament on that date. Finding the ratings of
+# any number of (player, date) pairs is then a single vectorized binary search. Added entries are buffered and sorted in all at once
+class RatingHistory:
+    DATE_BITS = 20
+
+    def __init__(self):
+        self.keys = numpy.empty(0, dtype=numpy.int64)
+        self.ratings = numpy.empty(0, dtype=numpy.int16)
+        self.pending = []
+
+    def __len__(self):
+        self.flush()
+
+        return len(self.keys)
+
+    def __getstate__(self):
+        self.flush()
+
+        return { 'keys': self.keys, 'ratings': self.ratings }
+
+    def __setstate__(self, state):
+        self.keys = state['keys']
+        self.ratings = state['ratings']
+        self.pending = []
+
+    def add(self, player_id, entries):
+        if entries:
+            dates, ratings = zip(*entries)
+            self.pending.append((player_id << self.DATE_BITS | numpy.array(dates, dtype=numpy.int64), numpy.array(ratings, dtype=numpy.int16)))
+
+        return self
+
+    # an entry for the same player and date as an earlier one replaces it
+    def flush(self):
+        if not self.pending:
+            return self
+
+        keys = numpy.concatenate([self.keys] + [keys for keys, _ in self.pending])
+        ratings = numpy.concatenate([self.ratings] + [ratings for _, ratings in self.pending])
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        last_entries = numpy.append(keys[1:] != keys[:-1], True)
+        self.keys = keys[last_entries]
+        self.ratings = ratings[order][last_entries]
+        self.pending = []
+
+        return self
+
+    # the rating of each player at each date: their rating after their last tournament before it or, for a date before their first
+    # tournament, after that one. Players without any history keep their default rating
+    def ratings_at(self, player_ids, dates, default_ratings):
+        self.flush()
+        player_ids = numpy.asarray(player_ids, dtype=numpy.int64)
+
+        if not len(self.keys):
+            return numpy.array(default_ratings, dtype=numpy.int16)
 
-            try:
-                winner_id = int(re.search(r'\?uai=(\d+)&', retrieve_href(winner['onclick'])).group(1))
-                loser_id = int(re.search(r'\?uai=(\d+)&', retrieve_href(loser['onclick'])).group(1))
-            except KeyError:
-                continue
+        positions = numpy.searchsorted(self.keys, player_ids << self.DATE_BITS | dates)
+        earlier = numpy.maximum(positions - 1, 0)
+        later = numpy.minimum(positions, len(self.keys) - 1)
+        ratings = numpy.where(self.keys[later] >> self.DATE_BITS == player_ids, self.ratings[later], default_ratings)
 
-            if winner_id not in player_info_dict:
-                if USE_MAX:
-                    continue
-                add_player(winner_id, player_info_dict, us_cities_states_dict, nonexistent_usatt_ids)
+        return numpy.where((positions > 0) & (self.keys[earlier] >> self.DATE_BITS == player_ids), self.ratings[earlier], ratings)
 
-            if loser_id not in player_info_dict:
-                if USE_MAX:
-                    continue
-                add_player(loser_id, player_info_dict, us_cities_states_dict, nonexistent_usatt_ids)
+    # rates the matches of match_store from row start on at the dates of their tournaments in place; matches of tournaments missing from
+    # tourney_dates keep their ratings. Rating matches again with the same history leaves them unchanged
+    def apply(self, match_store, tourney_dates, start=0):
+        tourney_ids, tourney_indices = numpy.unique(match_store['tourney_id'][start:], return_inverse=True)
+        match_dates = numpy.array([tourney_dates.get(tourney_id, -1) for tourney_id in tourney_ids.tolist()], dtype=numpy.int64)[tourney_indices]
+        dated_matches = match_dates >= 0
 
-            try:
-                winner_location, winner_rating = player_info_dict[winner_id]
-                loser_location, loser_rating = player_info_dict[loser_id]
-                winner_rating_interval = None
-                loser_rating_interval = None
-
-                try:
-                    winner_rating_interval = rating_intervals[winner_rating].pop().data
-                    loser_rating_interval = rating_intervals[loser_rating].pop().data
-                except:
-                    continue
-            except:
-                continue
+        for side in ['winner', 'loser']:
+            ratings = match_store[side + '_rating'][start:]
+            ratings[dated_matches] = self.ratings_at(match_store[side + '_id'][start:][dated_matches], match_dates[dated_matches], ratings[dated_matches])
 
-            if loser_rating_interval not in location_info_dict:
-                location_info_dict[loser_rating_interval] = {}
-            if winner_rating_interval not in location_info_dict:
-                location_info_dict[winner_rating_interval] = {}
+        return match_store
 
-            if loser_location not in location_info_dict[loser_rating_interval]:
-                location_info_dict[loser_rating_interval][loser_location] = { 'W': {}, 'L': {} }
-            if winner_location not in location_info_dict[winner_rating_interval]:
-                location_info_dict[winner_rating_interval][winner_location] = { 'W': {}, 'L': {} }
+# the rating history of player_ids, read off the tournament history on their player pages. Players never fetched or fetched more than
+# CACHE_TTL ago are fetched concurrently. The history and every player's fetch time are kept in RATING_HISTORY (and checkpointed while
+# fetching), so later runs only fetch new players
+@run_report.stage('get_rating_history')
+def get_rating_history(player_ids, max_workers=MAX_WORKERS):
+    checkpointer = Checkpointer(RATING_HISTORY)
+    rating_history_state = load_checkpoint(RATING_HISTORY) or { 'fetch_times': {}, 'rating_history': RatingHistory() }
+    fetch_times = rating_history_state['fetch_times']
+    rating_history = rating_history_state['rating_history']
+    expiry_time = time.time() - CACHE_TTL
+    new_ids = [player_id for player_id in player_ids if fetch_times.get(player_id, 0) < expiry_time]
+    progress = Progress('Rating histories', len(new_ids))
 
-            if winner_location in location_info_dict[loser_rating_interval][loser_location]['L']:
-                # i.e. if the player loses to a higher-rated player, a positive number will be appended to the list.
-                location_info_dict[loser_rating_interval][loser_location]['L'][winner_location].append(winner_rating - loser_rating)
-            else:
-                location_info_dict[loser_rating_interval][loser_location]['L'][winner_location] = [winner_rating - loser_rating]
+    print('Fetching the rating history of {} players.'.format(len(new_ids)))
 
-            if loser_location in location_info_dict[winner_rating_interval][winner_location]['W']:
-                # i.e. if the player beats a higher-rated player, a positive number will be appended to the list.
-                location_info_dict[winner_rating_interval][winner_location]['W'][loser_location].append(loser_rating - winner_rating)
-            else:
-                location_info_dict[winner_rating_interval][winner_location]['W'][loser_location] = [loser_rating - winner_rating]
-                
+    player_pages = ordered_map(lambda player_id: fetcher.get('{}/userAccount/up/{}'.format(URL, player_id)), new_ids, max_workers)
 
-        return num_matches, tourney_page
+    for index, (player_id, player_page) in enumerate(zip(new_ids, player_pages)):
+        with run_report.stage('parse_rating_histories'):
+            rating_history.add(player_id, extract_rating_history(player_page))
 
-    tourney_ids = get_tourney_ids()
-    num_tourneys = len(tourney_ids)
-    nonexistent_usatt_ids = []
-    total_num_matches = 0
+        fetch_times[player_id] = time.time()
+        run_report.count('rating_histories')
+        progress.update(index)
+        checkpointer.maybe_save(rating_history_state)
 
-    for index, tourney_id in enumerate(tourney_ids):
-        offset = 0
+    checkpointer.save(rating_history_state)
 
-        if USE_MAX and index % 50 == 0 and index != 0:
-            print('Completed information gathering for {} tournaments.'.format(index))
+    return rating_history
 
-        num_matches, tourney_page = tourney_page_helper(offset, nonexistent_usatt_ids)
-        total_num_matches += num_matches
-        offset += matches_per_page
-        offset_limit = None
+# the (winner_id, loser_id) of every match on the page, or None for matches missing a player link
+def parse_tourney_page(tourney_page):
+    player_matches = extract_match_cells(tourney_page)
+    match_pairs = []
+
+    for winner_onclick, loser_onclick in zip(player_matches[0::2], player_matches[1::2]):
+        if winner_onclick is None or loser_onclick is None:
+            match_pairs.append(None)
+            continue
+
+        winner_id = int(re.search(r'\?uai=(\d+)&', retrieve_href(winner_onclick)).group(1))
+        loser_id = int(re.search(r'\?uai=(\d+)&', retrieve_href(loser_onclick)).group(1))
+        match_pairs.append((winner_id, loser_id))
+
+    return match_pairs
+
+# adds the matches between known players to match_store and returns how many were added; matches with an unknown player are dropped
+def attribute_matches(match_store, tourney_id, match_pairs, player_info_dict):
+    num_attributed_matches = 0
+
+    for match_pair in match_pairs:
+        if match_pair is None:
+            continue
+
+        winner_id, loser_id = match_pair
 
         try:
-            if (tourney_page.find('span', { 'class': ['step', 'gap'] })):
-                offset_limit = int(re.search(r'offset=(\d+)', tourney_page.find('span', { 'class': ['step', 'gap'] }).next_sibling['href']).group(1))
-            else:
-                offset_limit = int(re.search(r'offset=(\d+)', tourney_page.find_all('a', { 'class': 'step'})[-1]['href']).group(1))
-        except:
-            offset_limit = 0
+            winner_location, winner_rating = player_info_dict[winner_id]
+            loser_location, loser_rating = player_info_dict[loser_id]
+        except KeyError:
+            continue
+
+        match_store.add_match(tourney_id, winner_id, winner_location, winner_rating, loser_id, loser_location, loser_rating)
+        num_attributed_matches += 1
+
+    return num_attributed_matches
+
+# state of a tournament worker process, set once by init_tourney_worker instead of being sent along with every tournament
+tourney_worker_state = {}
 
-        while offset <= offset_limit:
-            num_matches, tourney_page = tourney_page_helper(offset, nonexistent_usatt_ids)
-            total_num_matches += num_matches
-            offset += matches_per_page
+def init_tourney_worker(player_info_dict, html_parser):
+    global HTML_PARSER
 
-            time.sleep(0.5)
+    HTML_PARSER = html_parser
+    tourney_worker_state['player_info_dict'] = player_info_dict
 
-        time.sleep(1)
+# parses and attributes one tournament in a worker process; returns the match count of each page and the tournament's partial match store
+def process_tourney_shard(tourney_shard):
+    tourney_id, tourney_pages = tourney_shard
 
+    if tourney_pages is None:
+        return None
+
+    match_store = MatchStore(capacity=len(tourney_pages) * 100)
+    page_counts = []
+
+    for offset, tourney_page in tourney_pages:
+        match_pairs = parse_tourney_page(tourney_page)
+        attribute_matches(match_store, tourney_id, match_pairs, tourney_worker_state['player_info_dict'])
+        page_counts.append((offset, len(match_pairs)))
+
+    return page_counts, match_store
+
+# with a StatisticsAccumulator as statistics (STREAMING_STATS), new matches are folded into it instead of being kept in the match store.
+# With a RatingHistory (USE_RATING_HISTORY), matches are rated at the dates of their tournaments rather than at the current ratings
+@run_report.stage('get_main_info')
+def get_main_info(player_info_dict, city_state_index, matches_per_page=100, max_workers=MAX_WORKERS, num_processes=NUM_PROCESSES, statistics=None, rating_history=None):
+    def record_page(tourney_id, offset, num_matches):
+        ingest_state['total_num_matches'] += num_matches
+        run_report.count('tourney_pages')
+        run_report.count('matches', num_matches)
+        ingested_pages.setdefault(tourney_id, []).append(offset)
+
+    # players that are still unknown at this point were not found, so their matches are dropped
+    def tourney_page_helper(tourney_id, match_pairs):
+        page_match_store = match_store if statistics is None else MatchStore(capacity=len(match_pairs))
+        page_start = len(page_match_store)
+        run_report.count('attributed_matches', attribute_matches(page_match_store, tourney_id, match_pairs, player_info_dict))
+
+        if rating_history is not None:
+            rating_history.apply(page_match_store, tourney_dates, page_start)
+
+        if statistics is not None:
+            statistics.add(page_match_store)
+
+        return len(match_pairs)
+
+    # a tournament whose pages could not be fetched is skipped and left un-ingested, so the next run tries it again
+    def fetch_pages(tourney_id):
+        try:
+            return fetch_tourney_pages(tourney_id, matches_per_page, set(ingested_pages.get(tourney_id, ())))
+        except requests.RequestException as e:
+            print('Skipping tournament {}, its pages could not be fetched ({}).'.format(tourney_id, e))
+            run_report.count('failed_tournaments')
+            return None
+
+    checkpointer = Checkpointer(INGEST_STATE)
+    ingest_state = load_ingest_state()
+    ingested_pages = ingest_state['ingested_pages']
+    ingested_tourneys = ingest_state['ingested_tourneys']
+    match_store = ingest_state['match_store']
+    nonexistent_usatt_ids = ingest_state['nonexistent_usatt_ids']
+    tourney_dates = ingest_state.setdefault('tourney_dates', {})
+    resolve_unknown_players = RESOLVE_UNKNOWN_PLAYERS or not USE_MAX
+    player_lookups = load_player_lookups() if resolve_unknown_players else {}
+    player_lookups_checkpointer = Checkpointer(PLAYER_LOOKUPS)
+
+    # matches ingested while streaming only live in the saved statistics, so the match store alone would silently leave them out
+    if statistics is None and ingest_state.get('statistics') is not None:
+        raise ValueError('{} holds streaming statistics whose matches are not in its match store. Set STREAMING_STATS = True again, '
+                         'or delete the file to re-scrape every tournament without streaming.'.format(INGEST_STATE))
+
+    tourney_ids =[tourney_id for tourney_id in get_tourney_ids(tourney_dates=tourney_dates) if tourney_id not in ingested_tourneys]
+
+    # matches ingested before the rating history was turned on (or before it last changed) are rated again
+    if rating_history is not None:
+        rating_history.apply(match_store, tourney_dates)
+
+    # statistics carry on from the saved ones, or from the match store if matches were ingested before streaming was turned on
+    if statistics is not None:
+        if ingest_state.get('statistics') is not None:
+            statistics.merge(ingest_state['statistics'])
+        else:
+            statistics.add(match_store)
+        ingest_state['statistics'] = statistics
+
+    print('Found {} tournaments not yet ingested.'.format(len(tourney_ids)))
+
+    progress = Progress('Tournaments', len(tourney_ids))
+
+    # pages are fetched concurrently but consumed in tournament order, so the result matches a serial run;
+    # fetch_wait is the time spent waiting on the network rather than processing
+    fetched_tourney_pages = run_report.iterate('fetch_wait', ordered_map(fetch_pages, tourney_ids, max_workers))
+
+    # without player lookups every tournament is independent, so tournaments are parsed and attributed on a process pool and the
+    # partial match stores are merged back in tournament order. Lookups add players that later tournaments depend on, so they run serially
+    if num_processes > 1 and not resolve_unknown_players:
+        tourney_shards = ordered_map(process_tourney_shard, zip(tourney_ids, fetched_tourney_pages), num_processes, ProcessPoolExecutor,
+                                     mp_context=multiprocessing.get_context('spawn'), initializer=init_tourney_worker, initargs=(player_info_dict, HTML_PARSER))
+
+        for index, tourney_shard in enumerate(run_report.iterate('shard_wait', tourney_shards)):
+            tourney_id = tourney_ids[index]
+            progress.update(index)
+
+            if USE_MAX and index % 50 == 0 and index != 0:
+                print('Completed information gathering for {} tournaments.'.format(index))
+
+            if tourney_shard is None:
+                continue
+
+            page_counts, tourney_match_store = tourney_shard
+
+            with run_report.stage('merge_partials'):
+                if rating_history is not None:
+                    rating_history.apply(tourney_match_store, tourney_dates)
+
+                if statistics is None:
+                    match_store.merge(tourney_match_store)
+                else:
+                    statistics.add(tourney_match_store)
+
+            run_report.count('attributed_matches', len(tourney_match_store))
+
+            for offset, num_matches in page_counts:
+                record_page(tourney_id, offset, num_matches)
+
+            # the whole tournament is merged at once, so the state is only consistent at tournament boundaries
+            ingested_tourneys.add(tourney_id)
+            run_report.count('tournaments')
+            checkpointer.maybe_save(ingest_state)
+    else:
+        for index, tourney_pages in enumerate(fetched_tourney_pages):
+            tourney_id = tourney_ids[index]
+            progress.update(index)
+
+            if USE_MAX and index % 50 == 0 and index != 0:
+                print('Completed information gathering for {} tournaments.'.format(index))
+
+            if tourney_pages is None:
+                continue
+
+            with run_report.stage('parse_tourney_pages'):
+                tourney_matches = [(offset, parse_tourney_page(tourney_page)) for offset, tourney_page in tourney_pages]
+
+            # players missing from player_info_dict are looked up in one batch per tournament, before any of its matches are attributed
+            if resolve_unknown_players:
+                player_ids = [player_id for _, match_pairs in tourney_matches for match_pair in match_pairs if match_pair for player_id in match_pair]
+                with run_report.stage('resolve_players'):
+                    failed_ids = resolve_players(player_ids, player_info_dict, city_state_index, nonexistent_usatt_ids, player_lookups, max_workers)
+                player_lookups_checkpointer.maybe_save(player_lookups)
+
+                # attributing now would drop the matches of those players for good, so the tournament is left for the next run
+                if failed_ids:
+                    print('Skipping tournament {}, {} of its players could not be looked up.'.format(tourney_id, len(failed_ids)))
+                    run_report.count('failed_tournaments')
+                    continue
+
+            # the state is consistent after every page, so a checkpoint may be taken at any page boundary
+            for offset, match_pairs in tourney_matches:
+                record_page(tourney_id, offset, tourney_page_helper(tourney_id, match_pairs))
+                checkpointer.maybe_save(ingest_state)
+
+            ingested_tourneys.add(tourney_id)
+            run_report.count('tournaments')
+
+    checkpointer.save(ingest_state)
+
+    if resolve_unknown_players:
+        player_lookups_checkpointer.save(player_lookups)
+
+    return ingest_state['total_num_matches'], match_store
+
+# derives the rating_interval -> location -> 'W'/'L' -> opponent location -> rating differences view from the match store,
+# starting from the locations already present in location_info_dict
+def build_location_info_dict(match_store, rating_bins, location_info_dict):
     populated_location_info_dict = copy.deepcopy(location_info_dict)
+    winner_ratings = match_store['winner_rating'].tolist()
+    loser_ratings = match_store['loser_rating'].tolist()
+    winner_locations = [match_store.locations[code] for code in match_store['winner_location'].tolist()]
+    loser_locations = [match_store.locations[code] for code in match_store['loser_location'].tolist()]
+    winner_bins = rating_bins.codes(match_store['winner_rating']).tolist()
+    loser_bins = rating_bins.codes(match_store['loser_rating']).tolist()
+
+    for winner_location, winner_rating, winner_bin, loser_location, loser_rating, loser_bin in zip(winner_locations, winner_ratings, winner_bins, loser_locations, loser_ratings, loser_bins):
+        if winner_bin < 0 or loser_bin < 0:
+            continue
+
+        winner_rating_interval = rating_bins.labels[winner_bin]
+        loser_rating_interval = rating_bins.labels[loser_bin]
+
+        loser_info = populated_location_info_dict.setdefault(loser_rating_interval, {}).setdefault(loser_location, { 'W': {}, 'L': {} })
+        winner_info = populated_location_info_dict.setdefault(winner_rating_interval, {}).setdefault(winner_location, { 'W': {}, 'L': {} })
 
-    return total_num_matches, populated_location_info_dict
+        # i.e. if the player loses to a higher-rated player, a positive number will be appended to the list.
+        loser_info['L'].setdefault(winner_location, []).append(winner_rating - loser_rating)
+        # i.e. if the player beats a higher-rated player, a positive number will be appended to the list.
+        winner_info['W'].setdefault(loser_location, []).append(loser_rating - winner_rating)
+
+    return populated_location_info_dict
 
 def calculate_statistics_helper(losses, wins):
     win_ratio = None
@@ -352,6 +1767,7 @@ def calculate_statistics_helper(losses, wins):
         'win_ratio': win_ratio
     }
 
+@run_report.stage('calculate_statistics')
 def calculate_statistics(location_info_dict):
     location_stats = {}
     losses_by_state = None
@@ -405,8 +1821,256 @@ def calculate_statistics(location_info_dict):
 
     return location_stats
 
+# groups the (key, value) records in one sort and returns, per distinct key, its count, mean and median exactly as numpy.mean/median would
+def grouped_mean_median(keys, values):
+    # rating differences of int16 ratings fit in 17 bits, so each key and value pair sorts as a single int64
+    packed = numpy.sort((keys << 17) | (values + (1 << 16)))
+    sorted_keys = packed >> 17
+    sorted_values = ((packed & ((1 << 17) - 1)) - (1 << 16)).astype(numpy.float64)
+    starts = numpy.flatnonzero(numpy.diff(sorted_keys, prepend=-1))
+    counts = numpy.diff(starts, append=len(packed))
+
+    if not len(starts):
+        return starts, counts, sorted_values, sorted_values
+
+    # the values are integers, so these float sums are exact and the division matches numpy.mean bit for bit
+    means = numpy.add.reduceat(sorted_values, starts) / counts
+    upper_middles = sorted_values[starts + counts // 2]
+    lower_middles = sorted_values[starts + (counts - 1) // 2]
+    medians = numpy.where(counts % 2 == 1, upper_middles, (lower_middles + upper_middles) / 2)
+
+    return sorted_keys[starts], counts, means, medians
+
+# assembles location_stats for the given (rating_interval, location) cells from side_stats, mapping (rating_interval, location, 'L'/'W') to the
+# (count, mean, median) of all of the side's rating differences, and opponent_stats, mapping the same keys to those per opponent location
+def assemble_location_stats(cells, side_stats, opponent_stats):
+    location_stats = {}
+
+    for rating_interval, location in cells:
+        if location in location_stats.get(rating_interval, {}):
+            continue
+
+        losses_by_state = opponent_stats.get((rating_interval, location, 'L'), {})
+        wins_by_state = opponent_stats.get((rating_interval, location, 'W'), {})
+        num_losses, avg_loss, median_loss = side_stats.get((rating_interval, location, 'L'), (0, 'N/A', 'N/A'))
+        num_wins, avg_win, median_win = side_stats.get((rating_interval, location, 'W'), (0, 'N/A', 'N/A'))
+        states_stats = {}
+
+        for state, (state_num_losses, state_avg_loss, state_median_loss) in losses_by_state.items():
+            states_stats[state] = {
+                'avg_loss_rating_diff': state_avg_loss,
+                'avg_win_rating_diff': 'N/A',
+                'median_loss_rating_diff': state_median_loss,
+                'median_win_rating_diff': 'N/A',
+                'num_losses': state_num_losses,
+                'num_wins': 'N/A',
+                'win_ratio': 'N/A'
+            }
+
+        for state, (state_num_wins, state_avg_win, state_median_win) in wins_by_state.items():
+            if state not in states_stats:
+                states_stats[state] = { 'avg_loss_rating_diff': 'N/A', 'median_loss_rating_diff': 'N/A', 'num_losses': 'N/A' }
+            states_stats[state]['avg_win_rating_diff'] = state_avg_win
+            states_stats[state]['median_win_rating_diff'] = state_median_win
+            states_stats[state]['num_wins'] = state_num_wins
+            states_stats[state]['win_ratio'] = state_num_wins / (state_num_wins + losses_by_state[state][0]) if state in losses_by_state else 'N/A'
+
+        location_stats.setdefault(rating_interval, {})[location] = {
+            'avg_win_rating_diff': avg_win,
+            'avg_loss_rating_diff': avg_loss,
+            'median_win_rating_diff': median_win,
+            'median_loss_rating_diff': median_loss,
+            'num_losses': num_losses,
+            'num_wins': num_wins,
+            'win_ratio': num_wins / (num_wins + num_losses) if num_wins + num_losses else 0,
+            'states_stats': states_stats
+        }
+
+    return location_stats
+
+# one record per side of every match in match_store: the rating interval and location of the player, the opponent's location, whether it
+# was a loss (0) or a win (1) and the rating difference as build_location_info_dict defines it. Matches outside the rating bins are left out
+def match_side_records(match_store, rating_bins):
+    winner_ratings = match_store['winner_rating'].astype(numpy.int64)
+    loser_ratings = match_store['loser_rating'].astype(numpy.int64)
+    winner_intervals = rating_bins.codes(winner_ratings)
+    loser_intervals = rating_bins.codes(loser_ratings)
+    valid = (winner_intervals >= 0) & (loser_intervals >= 0)
+    winner_locations = match_store['winner_location'][valid].astype(numpy.int64)
+    loser_locations = match_store['loser_location'][valid].astype(numpy.int64)
+
+    return (
+        numpy.concatenate([loser_intervals[valid], winner_intervals[valid]]),
+        numpy.concatenate([loser_locations, winner_locations]),
+        numpy.concatenate([winner_locations, loser_locations]),
+        numpy.repeat(numpy.array([0, 1], dtype=numpy.int64), len(winner_locations)),
+        numpy.concatenate([winner_ratings[valid] - loser_ratings[valid], loser_ratings[valid] - winner_ratings[valid]])
+    )
+
+# computes the same location_stats as calculate_statistics(build_location_info_dict(...)) in a few grouped passes over the match store
+@run_report.stage('calculate_statistics_vectorized')
+def calculate_statistics_vectorized(match_store, rating_bins, location_info_dict):
+    record_intervals, record_locations, record_opponents, record_kinds, record_diffs = match_side_records(match_store, rating_bins)
+    num_locations = max(len(match_store.locations), 1)
+    side_keys = (record_intervals * num_locations + record_locations) * 2 + record_kinds
+    opponent_keys = side_keys * num_locations + record_opponents
+    side_name = lambda side_key: (rating_bins.labels[side_key // 2 // num_locations], match_store.locations[side_key // 2 % num_locations], 'LW'[side_key % 2])
+    side_stats = {}
+    opponent_stats = {}
+
+    for group_key, count, mean, median in zip(*grouped_mean_median(side_keys, record_diffs)):
+        side_stats[side_name(int(group_key))] = (int(count), mean, median)
+
+    for group_key, count, mean, median in zip(*grouped_mean_median(opponent_keys, record_diffs)):
+        side_key, opponent = divmod(int(group_key), num_locations)
+        opponent_stats.setdefault(side_name(side_key), {})[match_store.locations[opponent]] = (int(count), mean, median)
+
+    cells = [(rating_interval, location) for rating_interval in location_info_dict for location in location_info_dict[rating_interval]]
+    cells += [(rating_interval, location) for rating_interval, location, _ in side_stats]
+
+    return assemble_location_stats(cells, side_stats, opponent_stats)
+
+# running count, sum and histogram of the rating differences of every (rating interval, location, 'L'/'W', opponent location) cell, so memory
+# grows with the number of cells rather than with the number of matches. Every histogram is a fixed-range row of bin_width wide bins covering
+# all rating differences between two ratings inside the rating bins, and the rows of all cells live in one array. Accumulators over disjoint
+# sets of matches merge by addition. Means are exact. Medians are read off the histograms, taking each bin's midpoint: with bin_width 1 they
+# are exact, otherwise they are within bin_width / 2 of the exact median. Added matches are buffered up to STATS_BUFFER_MATCHES and folded in
+# together, which is far cheaper than folding in every tournament on its own
+class StatisticsAccumulator:
+    def __init__(self, rating_bins, bin_width=MEDIAN_BIN_WIDTH):
+        max_rating_diff = rating_bins.edges[-1] - 1 - rating_bins.edges[0]
+        self.rating_bins = rating_bins
+        self.bin_width = bin_width
+        self.min_bin = -max_rating_diff // bin_width
+        self.num_bins = max_rating_diff // bin_width - self.min_bin + 1
+        self.cell_rows = {}
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.totals = numpy.zeros(0, dtype=numpy.int64)
+        self.histograms = numpy.zeros((0, self.num_bins), dtype=numpy.uint32)
+        self.pending = MatchStore()
+
+    def __repr__(self):
+        return 'StatisticsAccumulator({!r}, bin_width={})'.format(self.rating_bins, self.bin_width)
+
+    def __len__(self):
+        self.flush()
+
+        return len(self.cell_rows)
+
+    # only the rows in use are saved
+    def __getstate__(self):
+        self.flush()
+        state = dict(self.__dict__, pending=None)
+
+        for name in ['counts', 'totals', 'histograms']:
+            state[name] = state[name][:len(self.cell_rows)].copy()
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pending = MatchStore()
+
+    # the histogram row of the cell, adding one (and growing the arrays by doubling) if the cell is new
+    def cell_row(self, cell_name):
+        if cell_name not in self.cell_rows:
+            if len(self.cell_rows) == len(self.counts):
+                capacity = max(2 * len(self.counts), 64)
+                self.counts = numpy.concatenate([self.counts, numpy.zeros(capacity - len(self.counts), dtype=numpy.int64)])
+                self.totals = numpy.concatenate([self.totals, numpy.zeros(capacity - len(self.totals), dtype=numpy.int64)])
+                self.histograms = numpy.concatenate([self.histograms, numpy.zeros((capacity - len(self.histograms), self.num_bins), dtype=numpy.uint32)])
+
+            self.cell_rows[cell_name] = len(self.cell_rows)
+
+        return self.cell_rows[cell_name]
+
+    def add(self, match_store):
+        self.pending.merge(match_store)
+
+        if len(self.pending) >= STATS_BUFFER_MATCHES:
+            self.flush()
+
+        return self
+
+    def flush(self):
+        pending = self.pending
+        record_intervals, record_locations, record_opponents, record_kinds, record_diffs = match_side_records(pending, self.rating_bins)
+        self.pending = MatchStore()
+
+        if not len(record_diffs):
+            return self
+
+        num_locations = len(pending.locations)
+        cell_keys, cell_indices = numpy.unique(((record_intervals * num_locations + record_locations) * 2 + record_kinds) * num_locations + record_opponents, return_inverse=True)
+        rows = []
+
+        for cell_key in cell_keys.tolist():
+            side_key, opponent = divmod(cell_key, num_locations)
+            interval_location, kind = divmod(side_key, 2)
+            interval, location = divmod(interval_location, num_locations)
+            rows.append(self.cell_row((self.rating_bins.labels[interval], pending.locations[location], 'LW'[kind], pending.locations[opponent])))
+
+        # the cells of cell_keys are distinct, and so are their rows and the (row, bin) pairs counted below
+        rows = numpy.array(rows, dtype=numpy.int64)
+        self.counts[rows] += numpy.bincount(cell_indices)
+        self.totals[rows] += numpy.bincount(cell_indices, weights=record_diffs).astype(numpy.int64)
+        histogram_keys, histogram_counts = numpy.unique(rows[cell_indices] * self.num_bins + record_diffs // self.bin_width - self.min_bin, return_counts=True)
+        self.histograms.reshape(-1)[histogram_keys] += histogram_counts.astype(numpy.uint32)
+
+        return self
+
+    def merge(self, other):
+        if self.rating_bins.edges != other.rating_bins.edges or self.rating_bins.labels != other.rating_bins.labels or self.bin_width != other.bin_width:
+            raise ValueError('Cannot merge {!r} into {!r}, their rating bins or median bin widths differ.'.format(other, self))
+
+        other.flush()
+        other_rows = numpy.array(list(other.cell_rows.values()), dtype=numpy.int64)
+        rows = numpy.array([self.cell_row(cell_name) for cell_name in other.cell_rows], dtype=numpy.int64)
+
+        self.counts[rows] += other.counts[other_rows]
+        self.totals[rows] += other.totals[other_rows]
+        self.histograms[rows] += other.histograms[other_rows]
+
+        return self
+
+    # the (count, mean, median) of the rating differences summarized by count, total and histogram
+    def summarize(self, count, total, histogram):
+        middle_bins = numpy.searchsorted(numpy.cumsum(histogram), [(count - 1) // 2, count // 2], side='right') + self.min_bin
+        middles = middle_bins * self.bin_width + (self.bin_width - 1) / 2
+
+        return count, total / count, (middles[0] + middles[1]) / 2
+
+    def side_and_opponent_stats(self):
+        self.flush()
+        side_rows = {}
+        opponent_stats = {}
+
+        for (rating_interval, location, kind, opponent), row in self.cell_rows.items():
+            side_rows.setdefault((rating_interval, location, kind), []).append(row)
+            opponent_stats.setdefault((rating_interval, location, kind), {})[opponent] = self.summarize(int(self.counts[row]), int(self.totals[row]), self.histograms[row])
+
+        side_stats = {}
+
+        for side_key, rows in side_rows.items():
+            side_stats[side_key] = self.summarize(int(self.counts[rows].sum()), int(self.totals[rows].sum()), self.histograms[rows].sum(axis=0))
+
+        return side_stats, opponent_stats
+
+# location_stats from a StatisticsAccumulator, equal to calculate_statistics_vectorized over the same matches when bin_width is 1
+@run_report.stage('calculate_statistics_streaming')
+def calculate_statistics_streaming(statistics, location_info_dict):
+    side_stats, opponent_stats = statistics.side_and_opponent_stats()
+    cells = [(rating_interval, location) for rating_interval in location_info_dict for location in location_info_dict[rating_interval]]
+    cells += sorted(set((rating_interval, location) for rating_interval, location, _ in side_stats))
+
+    return assemble_location_stats(cells, side_stats, opponent_stats)
+
+# writes each interval's tables strictly row by row, so the workbook can be streamed with constant_memory and formats are created only once
 def create_rating_interval_statistics_worksheet(location_stats, stats, workbook):
     sorted_rating_intervals = sorted(list(location_stats.keys()), key=lambda interval: int(interval.split(':')[0].replace('+', '')))
+    title_format = workbook.add_format({ 'bold': True, 'font_size': 20 })
+    header_format = workbook.add_format({ 'bold': True, 'align': 'center' })
+    cell_format = workbook.add_format({ 'align': 'center' })
 
     for rating_interval in sorted_rating_intervals:
         locations = set()
@@ -421,46 +2085,115 @@ def create_rating_interval_statistics_worksheet(location_stats, stats, workbook)
 
         sorted_locations = sorted(list(locations), key=lambda loc: (len(loc), loc))
         sorted_states = sorted(list(states), key=lambda state: (len(state), state))
-        sorted_states_index_mapping = { state: index for index, state in enumerate(sorted_states) }
         rating_interval_worksheet = workbook.add_worksheet('{} Statistics'.format(rating_interval.replace(':', ' to ')))
-        stat_title_row_index = 0
+        row_index = 0
 
         rating_interval_worksheet.set_column(0, 0, 20)
 
         for stat in stats:
-            rating_interval_worksheet.write(stat_title_row_index, 0, stat, workbook.add_format({ 'bold': True, 'font_size': 20 }))
-
-            for location_index, location in enumerate(sorted_locations):
-                stat_table_row_index = stat_title_row_index + 2
+            rating_interval_worksheet.write(row_index, 0, stat, title_format)
 
-                rating_interval_worksheet.write(stat_table_row_index + location_index + 1, 0, location, workbook.add_format({ 'bold': True, 'align': 'center' }))
+            if sorted_locations:
+                rating_interval_worksheet.write_row(row_index + 2, 1, sorted_states, header_format)
 
-                for state in sorted_states:
-                    rating_interval_worksheet.write(stat_table_row_index, sorted_states_index_mapping[state] + 1, state, workbook.add_format({ 'bold': True, 'align': 'center' }))
-
-                    if not location_stats[rating_interval][location]['states_stats'] or state not in location_stats[rating_interval][location]['states_stats']:
-                        rating_interval_worksheet.write(stat_table_row_index + location_index + 1, sorted_states_index_mapping[state] + 1, 'N/A', workbook.add_format({ 'align': 'center' }))
-                    elif stat in location_stats[rating_interval][location]['states_stats'][state]:
-                        state_stat = location_stats[rating_interval][location]['states_stats'][state][stat]
+            for location_index, location in enumerate(sorted_locations):
+                states_stats = location_stats[rating_interval][location]['states_stats']
+                stat_row = [states_stats[state].get(stat, 'N/A') if state in states_stats else 'N/A' for state in sorted_states]
 
-                        rating_interval_worksheet.write(stat_table_row_index + location_index + 1, sorted_states_index_mapping[state] + 1, state_stat, workbook.add_format({ 'align': 'center' }))
-                    else:
-                        rating_interval_worksheet.write(stat_table_row_index + location_index + 1, sorted_states_index_mapping[state] + 1, 'N/A', workbook.add_format({ 'align': 'center' }))
+                rating_interval_worksheet.write(row_index + location_index + 3, 0, location, header_format)
+                rating_interval_worksheet.write_row(row_index + location_index + 3, 1, stat_row, cell_format)
 
-            stat_title_row_index = stat_table_row_index + len(sorted_locations) + 2
+            row_index += len(sorted_locations) + 4
 
+@run_report.stage('create_excel_workbook')
 def create_excel_workbook(location_stats, sorted_locations):
     if list(location_stats.keys()):
-        workbook = xlsxwriter.Workbook('tt_statistics.xlsx')
-        stats = sorted(['avg_loss_rating_diff', 'avg_win_rating_diff', 'median_loss_rating_diff', 'median_win_rating_diff', 'num_losses', 'num_wins', 'win_ratio'])
+        workbook = xlsxwriter.Workbook('tt_statistics.xlsx', { 'constant_memory': True })
 
-        create_rating_interval_statistics_worksheet(location_stats, stats, workbook)
+        create_rating_interval_statistics_worksheet(location_stats, STATS, workbook)
         workbook.close()
     else:
         return print('Not enough data to create an excel workbook.')
 
+# flattens location_stats into tidy (interval, location, opponent, stat, value) rows; a location's totals have no opponent and 'N/A' becomes NaN
+def location_stats_frame(location_stats):
+    columns = { 'interval': [], 'location': [], 'opponent': [], 'stat': [], 'value': [] }
+
+    for rating_interval, stats_by_location in location_stats.items():
+        for location, location_info in stats_by_location.items():
+            cells = [(None, location_info)] + list(location_info['states_stats'].items())
+
+            for opponent, cell_stats in cells:
+                for stat in STATS:
+                    value = cell_stats.get(stat, 'N/A')
+
+                    columns['interval'].append(rating_interval)
+                    columns['location'].append(location)
+                    columns['opponent'].append(opponent)
+                    columns['stat'].append(stat)
+                    columns['value'].append(numpy.nan if value == 'N/A' else float(value))
+
+    return pd.DataFrame(columns)
+
+# one row per attributed match, with location codes resolved to their names
+def matches_frame(match_store):
+    columns = { name: match_store[name] for name, dtype in MatchStore.COLUMNS }
+
+    for name in ['winner_location', 'loser_location']:
+        columns[name] = pd.Categorical.from_codes(columns[name], categories=match_store.locations) if match_store.locations else []
+
+    return pd.DataFrame(columns)
+
+def write_parquet(tables, export_dir):
+    try:
+        for name, table in tables.items():
+            table.to_parquet(os.path.join(export_dir, '{}.parquet'.format(name)), index=False)
+    except ImportError:
+        print('Skipping parquet export, install pyarrow to enable it.')
+
+def write_csv(tables, export_dir):
+    for name, table in tables.items():
+        table.to_csv(os.path.join(export_dir, '{}.csv'.format(name)), index=False)
+
+# the database is built next to the old one and swapped in, so readers never see a half-written file
+def write_sqlite(tables, export_dir):
+    path = os.path.join(export_dir, 'tt_statistics.sqlite')
+    temp_path = path + '.tmp'
+
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    with sqlite3.connect(temp_path) as connection:
+        for name, table in tables.items():
+            table.to_sql(name, connection, index=False, chunksize=100000)
+
+        connection.execute('CREATE INDEX location_stats_cell ON location_stats (interval, location, opponent, stat)')
+        connection.execute('CREATE INDEX location_stats_stat ON location_stats (stat, interval)')
+        connection.execute('CREATE INDEX matches_tourney_id ON matches (tourney_id)')
+        connection.execute('CREATE INDEX matches_winner_id ON matches (winner_id)')
+        connection.execute('CREATE INDEX matches_loser_id ON matches (loser_id)')
+
+    connection.close()
+    os.replace(temp_path, path)
+
+EXPORT_WRITERS = {
+    'parquet': write_parquet,
+    'csv': write_csv,
+    'sqlite': write_sqlite
+}
+
+# writes location_stats and the raw matches as location_stats/matches tables in each of the given formats
+@run_report.stage('export_tables')
+def export_tables(location_stats, match_store, export_dir=EXPORT_DIR, formats=EXPORT_FORMATS):
+    tables = { 'location_stats': location_stats_frame(location_stats), 'matches': matches_frame(match_store) }
+
+    os.makedirs(export_dir, exist_ok=True)
+
+    for export_format in formats:
+        EXPORT_WRITERS[export_format](tables, export_dir)
+
 def main():
-    us_cities_states_dict = parse_us_cities_states_csv()
+    city_state_index = load_city_state_index()
     print('Finished parsing csv file.')
 
     '''
@@ -468,25 +2201,38 @@ def main():
     vs international players in certain matches. Individually adding the international players is an arduous process and
     adds to overhead, so we need to fill out the dictionary beforehand for all players (US and international).
     '''
-    rating_intervals = create_interval_tree()
-    player_info_dict, location_info_dict = get_preliminary_dicts(rating_intervals, us_cities_states_dict)
+    rating_bins = create_rating_bins()
+    player_info_dict, location_info_dict = get_preliminary_dicts(rating_bins, city_state_index)
     print('Finished retrieving preliminary info.')
     print('Number of players in player_info_dict: {}\n'.format(len(player_info_dict)))
 
-    total_num_matches, populated_location_info_dict = get_main_info(rating_intervals, player_info_dict, location_info_dict, us_cities_states_dict)
+    statistics = StatisticsAccumulator(rating_bins) if STREAMING_STATS else None
+    rating_history = get_rating_history(list(player_info_dict)) if USE_RATING_HISTORY else None
+    total_num_matches, match_store = get_main_info(player_info_dict, city_state_index, statistics=statistics, rating_history=rating_history)
     print('Finished retrieiving main info from a total of {} matches.\n'.format(total_num_matches))
 
-    sorted_locations = sorted(list(set(itertools.chain.from_iterable([list(location.keys()) for location in populated_location_info_dict.values()]))), key=lambda loc: (len(loc), loc))
-    print('Locations: {}\n'.format(sorted_locations))
+    if statistics is None:
+        if not USE_MAX:
+            pprint(build_location_info_dict(match_store, rating_bins, location_info_dict))
 
-    if not USE_MAX:
-        pprint(populated_location_info_dict)
-
-    location_stats = calculate_statistics(populated_location_info_dict)
+        location_stats = calculate_statistics_vectorized(match_store, rating_bins, location_info_dict)
+    else:
+        location_stats = calculate_statistics_streaming(statistics, location_info_dict)
     print('Finished calculating statistics.')
 
+    sorted_locations = sorted(list(set(itertools.chain.from_iterable([list(location.keys()) for location in location_stats.values()]))), key=lambda loc: (len(loc), loc))
+    print('Locations: {}\n'.format(sorted_locations))
+
     create_excel_workbook(location_stats, sorted_locations)
     print('Finished creating excel workbook.')
 
+    export_tables(location_stats, match_store)
+    print('Finished exporting tables to {}.'.format(EXPORT_DIR))
+    print('Fetch summary: {}'.format(fetcher.report()))
+    print('Cache summary: {}'.format(cache_stats))
+
+    run_report.write()
+    print('Wrote run report to {}.'.format(REPORT_PATH))
+
 if __name__ == '__main__':
     main()
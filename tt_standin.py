@@ -0,0 +1,209 @@
+import contextlib
+import functools
+import hashlib
+import itertools
+import os
+import sys
+import tempfile
+import threading
+
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tt_benchmark
+import tt_script
+
+NUM_MATCHES = 30000
+NUM_PLAYERS = 2000
+
+# local stand-in for the USATT website serving canned pages by URL path with an ETag and a Last-Modified date, answering requests that
+# revalidate either with 304. Paths in failing_paths are answered with 403, and the next throttled_paths[path] requests for a path with
+# alternately 503 and 429 and a Retry-After of 0 seconds
+class StandInHandler(BaseHTTPRequestHandler):
+    pages = {}
+    failing_paths = set()
+    throttled_paths = {}
+    last_modified = 'Sun, 15 Dec 2019 08:00:00 GMT'
+
+    def do_GET(self):
+        page = self.pages.get(self.path)
+
+        if self.path.split('?')[0] in self.failing_paths:
+            self.respond(403, 'Forbidden')
+        elif self.throttled_paths.get(self.path):
+            self.throttled_paths[self.path] -= 1
+            self.respond(429 if self.throttled_paths[self.path] % 2 else 503, 'Try again later', { 'Retry-After': '0' })
+        elif page is None:
+            self.respond(404, 'Not Found')
+        else:
+            validators = { 'ETag': '"{}"'.format(hashlib.sha1(page.encode('utf-8')).hexdigest()), 'Last-Modified': self.last_modified }
+
+            if self.headers.get('If-None-Match') == validators['ETag'] or self.headers.get('If-Modified-Since') == self.last_modified:
+                self.respond(304, '', validators)
+            else:
+                self.respond(200, page, validators)
+
+    def respond(self, status, text, headers={}):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# serves pages, a dict of URL path -> page, on a free local port from a background thread; returns the server and its URL
+def serve(pages):
+    handler = type('PagesHandler', (StandInHandler,), { 'pages': pages, 'failing_paths': set(), 'throttled_paths': {} })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+# crawls the players and ingests every tournament of the stand-in in a scratch directory, resuming from any state a run left there (and
+# ingesting a second time if ingest_twice), returning everything get_preliminary_dicts and get_main_info produced
+def run_ingestion(url, city_state_index, run_dir, max_workers, num_processes, ingest_twice=False, before_second_run=None):
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+    tt_script.URL = url
+    tt_script.USE_MAX = True
+    tt_script.fetcher = tt_script.Fetcher(requests_per_second=0, cache_dir=os.path.join(run_dir, 'http'))
+    rating_bins = tt_script.create_rating_bins()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        player_info_dict, location_info_dict = tt_script.get_preliminary_dicts(rating_bins, city_state_index, max_workers=max_workers)
+        total_num_matches, match_store = tt_script.get_main_info(player_info_dict, city_state_index, max_workers=max_workers, num_processes=num_processes)
+        ingested_tourneys = set(tt_script.load_ingest_state()['ingested_tourneys'])
+
+        if ingest_twice:
+            before_second_run()
+            total_num_matches, match_store = tt_script.get_main_info(player_info_dict, city_state_index, max_workers=max_workers, num_processes=num_processes)
+
+    return {
+        'player_info_dict': player_info_dict,
+        'total_num_matches': total_num_matches,
+        'matches': list(zip(*(column.tolist() for column in tt_benchmark.match_store_rows(match_store)))),
+        'location_stats': tt_script.calculate_statistics_vectorized(match_store, rating_bins, location_info_dict),
+        'ingested_tourneys': ingested_tourneys
+    }
+
+# fetches a page of the stand-in twice, checking that the second fetch revalidates it with a 304, then again while the stand-in throttles
+# it, checking that the fetch is retried as Retry-After asks and fails once the retries run out, all on the Fetcher's counters
+def check_fetcher(server, url, path, cache_dir):
+    throttled_paths = server.RequestHandlerClass.throttled_paths
+    page = server.RequestHandlerClass.pages[path]
+    fetcher = tt_script.Fetcher(requests_per_second=0, max_retries=2, cache_dir=cache_dir)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        assert fetcher.get(url + path) == page and fetcher.get(url + path) == page, 'a revalidated page differs from the served one'
+        assert fetcher.report()['not_modified'] == 1, 'an unchanged page was not revalidated with a 304'
+
+        throttled_paths[path] = 2
+        assert fetcher.get(url + path) == page, 'a throttled page differs from the served one'
+        assert fetcher.report()['retries'] == 2 and fetcher.report()['errors'] == 2, 'a throttled request was not retried once per 429 or 503'
+
+        throttled_paths[path] = 3
+
+        try:
+            fetcher.get(url + path)
+        except requests.HTTPError:
+            pass
+        else:
+            raise AssertionError('a request still throttled after its last retry did not fail')
+
+    fetch_report = fetcher.report()
+
+    assert (fetch_report['retries'], fetch_report['errors'], fetch_report['not_modified'], fetch_report['backoff_wait']) == (4, 5, 2, 0), 'unexpected fetch counters {}'.format(fetch_report)
+
+# while active, crawl state is checkpointed at every opportunity and the call of tt_script's function name after the first num_calls raises
+# KeyboardInterrupt, as if the run was interrupted there
+@contextlib.contextmanager
+def interrupted_after(name, num_calls):
+    func = getattr(tt_script, name)
+    checkpointer_class = tt_script.Checkpointer
+    calls = itertools.count()
+
+    def interrupting_func(*args, **kwargs):
+        if next(calls) == num_calls:
+            raise KeyboardInterrupt
+        return func(*args, **kwargs)
+
+    setattr(tt_script, name, interrupting_func)
+    tt_script.Checkpointer = functools.partial(checkpointer_class, interval=0)
+
+    try:
+        yield
+    finally:
+        setattr(tt_script, name, func)
+        tt_script.Checkpointer = checkpointer_class
+
+# rows in tournament order, so that a run which ingested some tournaments late compares equal to one that ingested them in order
+def sorted_matches(result):
+    return sorted(result['matches'], key=lambda match: match[0])
+
+def main():
+    num_matches = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MATCHES
+    pages = dict(tt_benchmark.synthetic_site_pages(num_matches, NUM_PLAYERS))
+    server, url = serve(pages)
+    csv_path = os.path.abspath(tt_script.US_CITIES_STATES_CSV)
+
+    with tempfile.TemporaryDirectory() as check_dir:
+        os.chdir(check_dir)
+        city_state_index = tt_script.load_city_state_index(csv_path)
+        city_state_index.load()
+        serial = run_ingestion(url, city_state_index, os.path.join(check_dir, 'serial'), 1, 1)
+
+        print('Stand-in at {} serving {} pages, {} matches ingested serially.'.format(url, len(pages), serial['total_num_matches']))
+
+        check_fetcher(server, url, '/t/search', os.path.join(check_dir, 'fetcher'))
+        print('  fetcher: pages revalidated with 304, 429 and 503 retried after Retry-After until the retries run out')
+
+        for name, max_workers, num_processes in [('concurrent fetching', tt_script.MAX_WORKERS, 1), ('process pool', tt_script.MAX_WORKERS, 2)]:
+            result = run_ingestion(url, city_state_index, os.path.join(check_dir, name.replace(' ', '_')), max_workers, num_processes)
+
+            assert result == serial, '{} gives a different result than a serial run'.format(name)
+            print('  {}: identical to the serial run'.format(name))
+
+        # a run interrupted halfway through the player listing, or in the middle of a tournament, resumes from its checkpoint
+        num_tourney_pages = tt_benchmark.synthetic_num_tourneys(num_matches) * tt_benchmark.PAGES_PER_TOURNEY
+        interruptions = [
+            ('get_preliminary_dicts', 'extract_player_rows', 1, tt_script.PRELIMINARY_CHECKPOINT),
+            ('get_main_info', 'attribute_matches', num_tourney_pages // 2 // tt_benchmark.PAGES_PER_TOURNEY * tt_benchmark.PAGES_PER_TOURNEY + 1, tt_script.INGEST_STATE)
+        ]
+
+        for name, interrupted_func, num_calls, checkpoint_path in interruptions:
+            run_dir = os.path.join(check_dir, 'interrupted_' + name)
+
+            try:
+                with interrupted_after(interrupted_func, num_calls):
+                    run_ingestion(url, city_state_index, run_dir, tt_script.MAX_WORKERS, 1)
+            except KeyboardInterrupt:
+                pass
+            else:
+                raise AssertionError('{} was not interrupted'.format(name))
+
+            assert os.path.exists(os.path.join(run_dir, checkpoint_path)), 'the interrupted {} left no checkpoint'.format(name)
+            assert run_ingestion(url, city_state_index, run_dir, tt_script.MAX_WORKERS, 1) == serial, 'a resumed {} gives a different result than a serial run'.format(name)
+            print('  {} interrupted after {} calls of {}: resumed run identical to the serial run'.format(name, num_calls, interrupted_func))
+
+        # a tournament whose results page fails is left out and picked up again by the next run
+        server.RequestHandlerClass.failing_paths.add('/t/tr/1')
+        result = run_ingestion(url, city_state_index, os.path.join(check_dir, 'failing_page'), tt_script.MAX_WORKERS, 1, True, server.RequestHandlerClass.failing_paths.clear)
+
+        assert 1 not in result['ingested_tourneys'] and 2 in result['ingested_tourneys'], 'a tournament whose page failed was recorded as ingested'
+        assert sorted_matches(result) == sorted_matches(serial) and result['location_stats'] == serial['location_stats'], 'a failed tournament was not ingested again'
+        print('  failing results page: tournament skipped, then ingested by the next run')
+
+        os.chdir(os.path.dirname(check_dir))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()